@@ -1,10 +1,11 @@
 from locust import HttpUser, task, between
 
 
-class SizeofUser(HttpUser):
+class DetectUser(HttpUser):
     wait_time = between(0.1, 1)
 
     @task
     def req(self):
         files = {'file': open("../images/apple.jpg", 'rb')}
-        self.client.post("/sizeof", files=files)
+        self.client.post("/detect?model=yolov3-tiny&confidence=0.5",
+                         files=files)
@@ -1,6 +1,108 @@
+from enum import Enum
 from pydantic import BaseModel
-from typing import Dict
+from typing import Dict, List, Optional
+
+
+# Model selection enum
+class Model(str, Enum):
+    yolov3tiny = "yolov3-tiny"
+    yolov3 = "yolov3"
+
+
+# Network input size enum, see `yoso.model.registry.INPUT_SIZES`
+class InputSize(str, Enum):
+    s320 = "320"
+    s416 = "416"
+    s608 = "608"
+
+
+# Encoding of annotated images, see `yoso.render.FORMATS`
+class ImageFormat(str, Enum):
+    jpeg = "jpeg"
+    webp = "webp"
 
 
 class CounterResponse(BaseModel):
     items: Dict[str, int]
+
+
+class ModelStats(BaseModel):
+    replicas: int
+    backend: str
+    input_size: int
+    output_layers: List[str]
+    load_seconds: float
+    memory_bytes: int
+    weights_bytes: int
+
+
+class ModelsResponse(BaseModel):
+    models: Dict[str, ModelStats]
+    # per inference worker process (inference_mode=process only)
+    workers: Dict[str, Dict[str, ModelStats]] = {}
+
+
+class Detection(BaseModel):
+    label: str
+    confidence: float
+    # x1, y1, x2, y2 in pixels
+    box: List[int]
+
+
+class ImageDetections(BaseModel):
+    filename: str
+    detections: List[Detection] = []
+    items: Dict[str, int] = {}
+    error: Optional[str] = None
+
+
+class BatchPredictionResponse(BaseModel):
+    model: Model
+    results: List[ImageDetections]
+
+
+class DetectionResponse(BaseModel):
+    model: Model
+    # size of the uploaded image (or of the original image it was resized
+    # from, when given), boxes are in its coordinates
+    width: int
+    height: int
+    detections: List[Detection]
+
+
+class StreamDetections(BaseModel):
+    # sequence number of the frame on its connection
+    frame: int
+    # frames dropped so far on the connection, as inference fell behind
+    dropped: int
+    width: int = 0
+    height: int = 0
+    detections: List[Detection] = []
+    # frame differencing decision (skip, roi or full) with `motion`
+    decision: Optional[str] = None
+    error: Optional[str] = None
+
+
+class VideoJobStatus(BaseModel):
+    id: str
+    name: str
+    # queued, running, done or failed
+    status: str
+    model: Model
+    # one frame processed every `sample_step`
+    sample_step: int
+    source_fps: float
+    frames_total: int
+    frames_read: int
+    frames_processed: int
+    # processed frames reusing the previous detections (with `motion`)
+    frames_skipped: int = 0
+    progress: float
+    # throughput, in processed frames per second
+    fps: float
+    annotated: bool
+    error: Optional[str] = None
+
+
+class VideoJobsResponse(BaseModel):
+    jobs: List[VideoJobStatus]
@@ -0,0 +1,78 @@
+"""
+Opt-in audit trail of the annotated images served by `/predict`.
+
+Images are written by a background thread, so the request path never
+touches the disk. Each file gets a unique name (concurrent uploads with
+the same filename no longer overwrite each other) and only the newest
+`max_files` are retained. Only files written by the sink, recognised by
+their `PREFIX`, are counted and pruned: anything else in the directory is
+left alone.
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+from uuid import uuid4
+
+from yoso.console import console
+
+# name prefix of the files written by the sink
+PREFIX = "audit-"
+
+
+class AuditSink:
+    """Asynchronously persist encoded images under `directory`.
+
+    Submissions are dropped, rather than blocking the request, when more
+    than `max_queue` images are waiting to be written.
+    """
+
+    def __init__(self, directory: str, max_files: int = 1000, max_queue=64):
+        assert max_files >= 1, "max_files must be at least 1"
+        self.directory = directory
+        self.max_files = max_files
+        self.queue = queue.Queue(maxsize=max_queue)
+        # files written by a previous run count towards the retention limit
+        existing = sorted((os.path.join(directory, x)
+                           for x in os.listdir(directory)
+                           if x.startswith(PREFIX)
+                           and os.path.isfile(os.path.join(directory, x))),
+                          key=os.path.getmtime)
+        self.files = deque(existing)
+        self.worker = threading.Thread(target=self._run,
+                                       name="yoso-audit-sink",
+                                       daemon=True)
+        self.worker.start()
+
+    def submit(self, filename: str, data: bytes) -> bool:
+        "Queue `data` to be saved, returns False if it was dropped"
+        try:
+            self.queue.put_nowait((filename, data))
+            return True
+        except queue.Full:
+            return False
+
+    def _path_for(self, filename):
+        "Unique destination path, keeping the uploaded base name for reference"
+        base_name = os.path.basename(filename)
+        return os.path.join(
+            self.directory,
+            f"{PREFIX}{time.time_ns()}-{uuid4().hex[:8]}-{base_name}")
+
+    def _run(self):
+        while True:
+            filename, data = self.queue.get()
+            path = self._path_for(filename)
+            try:
+                with open(path, "wb") as f:
+                    f.write(data)
+            except OSError as e:
+                console.log(f"[red]Audit sink failed to write {path}: {e}[/]")
+                continue
+            self.files.append(path)
+            while len(self.files) > self.max_files:
+                try:
+                    os.remove(self.files.popleft())
+                except OSError:
+                    pass
@@ -0,0 +1,185 @@
+"""
+Offline micro-benchmarks of the `/predict` pipeline, without HTTP.
+
+Runs every image under `images/` through each stage of the pipeline in
+isolation, for each model and OpenCV thread count:
+- `file_to_cv_image`: decoding of the (spooled) upload
+- `blobFromImage`: letterboxing/resizing into the network input
+- `net.forward`: the forward pass of a single image
+- `postprocess`: decoding of the outputs and NMS
+- `draw_bbox`: drawing of the detections (on a copy of the image)
+- `encode`: JPEG encoding of the annotated image
+
+Reports, per stage, the distribution (p50/p90/p99) of its duration over
+`repeats` runs of every image, and the mean/max python-side memory it
+allocates (`tracemalloc` peak, numpy buffers included; OpenCV's own
+allocations are not traced), measured in a separate untimed pass.
+
+usage (from the repo root):
+`python -m yoso.bench [--model NAME ...] [--threads N ...] [--repeats N]`
+"""
+import json
+import os
+import tracemalloc
+from tempfile import SpooledTemporaryFile
+from time import perf_counter
+
+import click
+import cv2
+import numpy as np
+
+from yoso.cvutils import file_to_cv_image
+from yoso.model.my_model import DetectionModel
+from yoso.render import encode
+
+# same spooling threshold as starlette's UploadFile
+SPOOL_MAX_SIZE = 1024 * 1024
+STAGES = ("file_to_cv_image", "blobFromImage", "net.forward", "postprocess",
+          "draw_bbox", "encode")
+
+
+class FakeUpload:
+    "Minimal stand-in for `fastapi.UploadFile`, decoding only uses `.file`"
+
+    def __init__(self, content: bytes):
+        self.file = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.file.write(content)
+        self.file.seek(0)
+
+
+def pipeline(od_model: DetectionModel, model: str, content: bytes,
+             confidence: float, nms_thresh: float, quality: int):
+    """The stages of a `/predict` request on `content`, as (name, thunk)
+    pairs: each thunk runs its stage on the previous stage's output"""
+    entry = od_model.registry.get(model)
+    size = od_model.input_size(model)
+    state = {}
+
+    def decode():
+        state["image"] = file_to_cv_image(FakeUpload(content))
+
+    def preprocess():
+        state["blob"] = od_model.blob([state["image"]], size)
+
+    def forward():
+        with entry.checkout() as net:
+            net.setInput(state["blob"])
+            state["outs"] = net.forward(entry.output_layers)
+
+    def postprocess():
+        outs = [out.reshape(-1, out.shape[-1]) for out in state["outs"]]
+        shape = state["image"].shape[:2]
+        state["detections"] = od_model.postprocess(
+            outs, shape, confidence, nms_thresh,
+            od_model.box_transform(shape, size))
+
+    def draw():
+        # drawing is in place: keep the decoded image for the next runs
+        state["annotated"] = od_model.draw_bbox(state["image"].copy(),
+                                                *state["detections"],
+                                                write_conf=True)
+
+    def jpeg():
+        encode(state["annotated"], "jpeg", quality)
+
+    return list(zip(STAGES, (decode, preprocess, forward, postprocess, draw,
+                             jpeg)))
+
+
+def summary(times, allocs):
+    p50, p90, p99 = np.percentile(np.asarray(times) * 1e3, [50, 90, 99])
+    return {
+        "p50_ms": float(p50),
+        "p90_ms": float(p90),
+        "p99_ms": float(p99),
+        "mean_alloc_kb": float(np.mean(allocs)) / 1024,
+        "max_alloc_kb": float(np.max(allocs)) / 1024,
+    }
+
+
+def bench(od_model, model, images, repeats, confidence, nms_thresh, quality):
+    "Per stage summaries of `model` over `images` (name, content pairs)"
+    times = {stage: [] for stage in STAGES}
+    allocs = {stage: [] for stage in STAGES}
+    for _, content in images:
+        stages = pipeline(od_model, model, content, confidence, nms_thresh,
+                          quality)
+        for _ in range(repeats):
+            for stage, run in stages:
+                tic = perf_counter()
+                run()
+                times[stage].append(perf_counter() - tic)
+        # allocations are traced apart, tracemalloc slowing everything down
+        for stage, run in stages:
+            tracemalloc.start()
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            allocs[stage].append(peak)
+    return {stage: summary(times[stage], allocs[stage]) for stage in STAGES}
+
+
+@click.command(help="Time each stage of the /predict pipeline offline")
+@click.option("--model",
+              "models",
+              multiple=True,
+              default=["yolov3-tiny", "yolov3"],
+              show_default=True)
+@click.option("--threads",
+              "thread_counts",
+              multiple=True,
+              type=click.IntRange(min=1),
+              default=[1, os.cpu_count() or 1],
+              show_default=True,
+              help="OpenCV thread counts")
+@click.option("--repeats", type=click.IntRange(min=1), default=5,
+              show_default=True)
+@click.option("--images-dir", type=click.Path(exists=True), default="images",
+              show_default=True)
+@click.option("--confidence", type=click.FLOAT, default=0.5,
+              show_default=True)
+@click.option("--nms-thresh", type=click.FLOAT, default=0.3,
+              show_default=True)
+@click.option("--quality", type=click.IntRange(1, 100), default=90,
+              show_default=True, help="JPEG quality")
+@click.option("--out", type=click.Path(), help="Save the results as JSON")
+def main(models, thread_counts, repeats, images_dir, confidence, nms_thresh,
+         quality, out):
+    images = []
+    for name in sorted(os.listdir(images_dir)):
+        with open(os.path.join(images_dir, name), "rb") as f:
+            images.append((name, f.read()))
+
+    od_model = DetectionModel()
+    od_model.preload(models)
+    # first forward passes pay for OpenCV's allocations
+    od_model.warmup(models)
+
+    results = []
+    print(f"images={len(images)} repeats={repeats}")
+    print(f"{'model':<13}{'threads':>8}  {'stage':<18}{'p50 ms':>9}"
+          f"{'p90 ms':>9}{'p99 ms':>9}{'alloc KB':>10}{'max KB':>10}")
+    for model in models:
+        for threads in thread_counts:
+            cv2.setNumThreads(threads)
+            stages = bench(od_model, model, images, repeats, confidence,
+                           nms_thresh, quality)
+            for stage, s in stages.items():
+                print(f"{model:<13}{threads:>8}  {stage:<18}"
+                      f"{s['p50_ms']:>9.2f}{s['p90_ms']:>9.2f}"
+                      f"{s['p99_ms']:>9.2f}{s['mean_alloc_kb']:>10.1f}"
+                      f"{s['max_alloc_kb']:>10.1f}")
+                results.append({
+                    "model": model,
+                    "threads": threads,
+                    "stage": stage,
+                    **s
+                })
+
+    if out:
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+In-process cache of detection results, keyed by upload content.
+
+The key is a fast hash of the raw upload bytes plus the model name, network
+input size and NMS threshold. Entries hold the detections obtained at a low
+confidence floor, so a later request with any confidence above that floor
+can be answered by filtering them: thresholding after NMS gives the same
+boxes as thresholding before, as a box can only be suppressed by a higher
+scoring one.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from yoso.prometheus import (CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS,
+                             CACHE_ENTRIES, CACHE_INFO)
+
+POLICIES = ("lru", "fifo")
+
+
+class DetectionCache:
+    """Size and TTL bounded cache of (bbox, label, conf) detections.
+
+    With the `lru` policy hits refresh an entry, so the least recently used
+    one is evicted first; with `fifo` the oldest inserted one is.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300.0, policy="lru"):
+        assert policy in POLICIES, f"Invalid cache policy {policy}"
+        assert max_entries >= 1, "max_entries must be at least 1"
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.policy = policy
+        # key -> (expiry, confidence floor, detections)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        CACHE_INFO.info({
+            "policy": policy,
+            "max_entries": str(max_entries),
+            "ttl_seconds": str(ttl),
+        })
+        CACHE_ENTRIES.set_function(lambda: len(self.entries))
+
+    @staticmethod
+    def key(buf, model, nms_thresh, input_size=None):
+        "Cache key of the raw upload `buf` for `model`, `nms_thresh` and size"
+        digest = hashlib.blake2b(buf, digest_size=16).hexdigest()
+        return f"{digest}:{model}:{input_size}:{nms_thresh}"
+
+    @staticmethod
+    def filter(detections, confidence):
+        "Keep the detections scoring above `confidence`"
+        bbox, label, conf = detections
+        keep = [i for i, c in enumerate(conf) if c > confidence]
+        return ([bbox[i] for i in keep], [label[i] for i in keep],
+                [conf[i] for i in keep])
+
+    def lookup(self, key, confidence, model):
+        """Detections of `key` at `confidence`, or None on a miss.
+
+        Entries computed at a floor above `confidence` cannot answer it.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                CACHE_EVICTIONS.labels(reason="ttl").inc()
+                entry = None
+            if entry is None or entry[1] > confidence:
+                CACHE_MISSES.labels(model=model).inc()
+                return None
+            if self.policy == "lru":
+                self.entries.move_to_end(key)
+        CACHE_HITS.labels(model=model).inc()
+        return self.filter(entry[2], confidence)
+
+    def store(self, key, floor, detections):
+        "Cache `detections`, computed with confidence threshold `floor`"
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, floor,
+                                 detections)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                CACHE_EVICTIONS.labels(reason="size").inc()
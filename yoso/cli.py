@@ -0,0 +1,72 @@
+"""
+Maintenance commands of the server.
+
+`python -m yoso.cli fetch-models` downloads the model files ahead of time
+(e.g. while building the container image) so that a server running with
+`YOSO_model_download=false` never blocks a request on a download. Every
+file must match the known-good SHA-256 shipped in `yoso/model/SHA256SUMS`,
+unless unpinned files are explicitly allowed.
+"""
+import click
+
+from yoso.config import ServerConfig
+from yoso.console import console
+from yoso.model.artifacts import (ArtifactStore, DEFAULT_DIR,
+                                   DOWNLOAD_MANIFEST_HEADER, MANIFEST)
+from yoso.model.registry import MODEL_SPECS, CLASSES_FILE_NAME, CLASSES_URL
+
+config = ServerConfig()
+
+
+@click.group(help="Maintenance commands for the YOSO prediction service")
+def cli():
+    pass
+
+
+@cli.command(help="Download and verify the files of the given models")
+@click.option("--model",
+              "models",
+              multiple=True,
+              type=click.Choice(list(MODEL_SPECS)),
+              help="Model to fetch (repeatable, default: preload_models)")
+@click.option("--dir",
+              "directory",
+              default=config.model_dir or DEFAULT_DIR,
+              show_default=True)
+@click.option("--write-checksums",
+              is_flag=True,
+              help="Pin the SHA-256 of files without one in the SHA256SUMS "
+              "shipped with the code (maintainers, on a trusted download)")
+@click.option("--allow-unpinned",
+              is_flag=True,
+              help="Accept files without a pinned SHA-256, recording the "
+              "hash of their download in the SHA256SUMS of --dir so they are "
+              "checked on load")
+def fetch_models(models, directory, write_checksums, allow_unpinned):
+    # files without a known-good SHA-256 fail, unless they are being pinned
+    # or explicitly allowed
+    store = ArtifactStore(directory,
+                          checksums=config.model_checksums,
+                          strict=not (write_checksums or allow_unpinned))
+    files = [(CLASSES_FILE_NAME, CLASSES_URL)]
+    for name in models or config.preload_models:
+        spec = MODEL_SPECS[name]
+        files += [(spec.config_file_name, spec.cfg_url),
+                  (spec.weights_file_name, spec.weights_url)]
+    for file_name, url in files:
+        store.verify(store.ensure(file_name, url))
+        console.log(f"[green]{file_name}[/] ok")
+    if write_checksums:
+        for file_name in store.record_checksums([f for f, _ in files]):
+            console.log(f"Pinned the SHA-256 of {file_name}")
+    elif allow_unpinned:
+        for file_name in store.record_checksums(
+                [f for f, _ in files],
+                manifest=store.path(MANIFEST),
+                header=DOWNLOAD_MANIFEST_HEADER):
+            console.log(f"[yellow]{file_name} has no pinned SHA-256[/], "
+                        "recorded the one of its download")
+
+
+if __name__ == "__main__":
+    cli()
@@ -7,6 +7,7 @@ followed by the name of the of the configuration parameter field
 
 """
 from pydantic import BaseSettings
+from typing import Dict, List
 
 
 class ServerConfig(BaseSettings):
@@ -16,8 +17,99 @@ class ServerConfig(BaseSettings):
     # application level
     dev_mode: bool = False
     upload_dir: str = "/tmp/yoso_image_upload"
+    # keep the newest `audit_max_files` annotated images in `upload_dir`
+    audit_images: bool = False
+    audit_max_files: int = 1000
     title: str = 'Deploying a ML Model with FastAPI'
     hanlder: str = "yoso.core:app"
+    # decode large uploads at 1/2, 1/4 or 1/8 resolution as long as
+    # their short side stays >= decode_reduce_to (0: always full resolution)
+    decode_reduce_to: int = 0
+    # models loaded at startup
+    preload_models: List[str] = ["yolov3-tiny", "yolov3"]
+    # warm-up detections per replica run once the models are loaded
+    warmup_iterations: int = 2
+    # where inference runs: "thread" (in the server process) or "process"
+    inference_mode: str = "thread"
+    inference_workers: int = 2
+    # detections not done after this many seconds fail the request with a
+    # 504, e.g. when the worker running them died (0: no timeout)
+    inference_timeout_seconds: float = 60.0
+    # network replicas per model, and OpenCV intra-op threads (-1: default)
+    model_replicas: int = 1
+    opencv_threads: int = -1
+    # network input size per model name (320, 416 or 608, e.g.
+    # '{"yolov3-tiny": 320}'), and whether to letterbox the images fed to
+    # the network, keeping their aspect ratio, rather than stretch them
+    input_sizes: Dict[str, int] = {}
+    letterbox: bool = True
+    # uploaded images larger than this many bytes, or pixels (read from
+    # their header), are rejected before being decoded (0: no limit)
+    max_upload_bytes: int = 20 * 1024 * 1024
+    max_image_pixels: int = 40_000_000
+    # default encoding quality (1-100) of the annotated images
+    jpeg_quality: int = 90
+    webp_quality: int = 80
+    # model files: directory (empty: cvlib's ~/.cvlib/...), expected SHA-256
+    # per file name (on top of yoso/model/SHA256SUMS and the directory's
+    # SHA256SUMS), and whether missing files may be downloaded on first use
+    model_dir: str = ""
+    model_checksums: Dict[str, str] = {}
+    model_download: bool = True
+    # inference runtime: "opencv" (darknet cfg/weights on the OpenCV DNN
+    # `dnn_backend`: default, opencv or inference_engine, and `dnn_target`:
+    # cpu or cpu_fp16), or "onnxruntime" (`<model>.onnx` exports found in
+    # `onnx_dir`, by default next to the darknet files; batching needs
+    # exports with a dynamic batch axis, static batch-1 ones run per image)
+    runtime: str = "opencv"
+    dnn_backend: str = "default"
+    dnn_target: str = "cpu"
+    onnx_dir: str = ""
+    # non-maximum suppression threshold, and whether to run it per class
+    nms_thresh: float = 0.3
+    per_class_nms: bool = False
+    # inference batching
+    batch_max_size: int = 8
+    batch_max_wait_ms: float = 5.0
+    # bounded executor running the CPU work of the inference endpoints:
+    # requests beyond workers + queue size get a 503 with Retry-After
+    inference_executor_workers: int = 4
+    inference_queue_size: int = 16
+    retry_after_seconds: int = 1
+    # most images accepted by a single /predict_batch request, and most
+    # bytes of their uploads and expanded archives (0: no limit)
+    batch_max_images: int = 256
+    batch_max_bytes: int = 256 * 1024 * 1024
+    # most concurrent /stream WebSocket connections
+    stream_max_connections: int = 16
+    # video jobs: outputs under `video_dir`; local paths are only accepted
+    # under `video_input_dir` (empty: uploads only)
+    video_dir: str = "/tmp/yoso_video_jobs"
+    video_input_dir: str = ""
+    video_job_workers: int = 1
+    # finished video jobs (and their outputs) are deleted after this many
+    # seconds, and beyond this many (0: no limit)
+    video_job_ttl_seconds: float = 24 * 3600
+    video_max_jobs: int = 100
+    # frame differencing of streams and video jobs (opt-in with `motion`):
+    # frames whose `motion_width` wide thumbnail has less than
+    # `motion_min_changed` of its pixels moved by > `motion_threshold` gray
+    # levels reuse the last detections, at most `motion_max_skip` in a row;
+    # with `motion_roi`, a changed region smaller than `motion_roi_max_area`
+    # of the frame is detected on alone
+    motion_threshold: int = 12
+    motion_min_changed: float = 0.002
+    motion_width: int = 160
+    motion_max_skip: int = 30
+    motion_roi: bool = False
+    motion_roi_max_area: float = 0.5
+    # detection cache, keyed by upload content: entries hold the detections
+    # above `cache_min_confidence`, evicted by `cache_policy` (lru or fifo)
+    cache_enabled: bool = True
+    cache_max_entries: int = 1024
+    cache_ttl_seconds: float = 300.0
+    cache_policy: str = "lru"
+    cache_min_confidence: float = 0.1
     # OpenTelemetry
     otel_instrument: bool = False
     otel_instrument_exporter: str = "console"
@@ -17,34 +17,55 @@ This software is adapted from coursera `introduction-to-machine-learning-in-prod
 ungraded lab week 1.
 
 """
+import asyncio
+import io
 import os
+import threading
+import numpy as np
+import zipfile
 from collections import Counter
-import cv2
+from typing import List, Optional
 import cvlib as cv
 # import nest_asyncio # for usage in jupyter
-from enum import Enum
 from pprint import pprint
 
 ## Fastapi imports
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends
-from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse
+from fastapi import (FastAPI, UploadFile, File, HTTPException, Depends, Header,
+                     WebSocket, WebSocketDisconnect, Query, status)
+from fastapi.responses import (Response, HTMLResponse, JSONResponse,
+                               FileResponse)
 ## Tracing
 from opentelemetry import trace
 
 ## Internal package imports
 from yoso.console import console
 import yoso.utils as utils
-from yoso.cvutils import file_to_cv_image
+from yoso.cvutils import (decode_image, image_size, reduced_read_flag,
+                          scale_boxes, upload_bytes)
 from yoso.config import ServerConfig
 from yoso.model.my_model import DetectionModel
+from yoso.model.batching import BatchScheduler
+from yoso.model.workers import WorkerPool
+from yoso.audit import AuditSink
+from yoso.cache import DetectionCache
+from yoso.executor import InferenceExecutor, Overloaded
+from yoso.streaming import LatestFrame
+from yoso.video import VideoJobManager
+from yoso.motion import FrameDiffer
+from yoso.render import FORMATS, encode
+from yoso.prometheus import (REQUESTS_REJECTED, STREAM_CONNECTIONS,
+                             STREAM_FRAMES, stage_timer, observe_detections)
 # Api models
-from yoso.api_models import CounterResponse
-
-
-# Model selection enum
-class Model(str, Enum):
-    yolov3tiny = "yolov3-tiny"
-    yolov3 = "yolov3"
+from yoso.api_models import (Model, CounterResponse, ModelsResponse,
+                             Detection, ImageDetections,
+                             BatchPredictionResponse, DetectionResponse,
+                             StreamDetections, VideoJobStatus, InputSize,
+                             VideoJobsResponse, ImageFormat)
+# optional compact encoding of /detect responses
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 # Load configuration
@@ -57,7 +78,81 @@ pprint(config.dict())
 app = FastAPI(title=config.title)
 
 # build detection model
-od_model = DetectionModel()
+opencv_threads = None if config.opencv_threads < 0 else config.opencv_threads
+model_options = dict(replicas=config.model_replicas,
+                     num_threads=opencv_threads,
+                     per_class_nms=config.per_class_nms,
+                     input_sizes=config.input_sizes,
+                     letterbox=config.letterbox,
+                     runtime=config.runtime,
+                     dnn_backend=config.dnn_backend,
+                     dnn_target=config.dnn_target,
+                     onnx_dir=config.onnx_dir or None,
+                     model_dir=config.model_dir or None,
+                     checksums=config.model_checksums,
+                     download=config.model_download)
+od_model = DetectionModel(**model_options)
+if config.inference_mode == "process":
+    # inference runs in worker processes, each with its own DetectionModel
+    detector = WorkerPool(n_workers=config.inference_workers,
+                          models=config.preload_models,
+                          model_options=model_options,
+                          warmup_iterations=config.warmup_iterations,
+                          task_timeout=config.inference_timeout_seconds
+                          or None)
+else:
+    # concurrent requests are batched into shared forward passes,
+    # with one batching worker per network replica
+    detector = BatchScheduler(od_model,
+                              max_batch_size=config.batch_max_size,
+                              max_wait=config.batch_max_wait_ms / 1000,
+                              workers=config.model_replicas)
+
+# dedicated, bounded pool for the CPU work of the inference endpoints
+executor = InferenceExecutor(max_workers=config.inference_executor_workers,
+                             max_queue=config.inference_queue_size)
+
+# Optionally answer repeated uploads from a cache of detections
+detection_cache = None
+if config.cache_enabled:
+    detection_cache = DetectionCache(max_entries=config.cache_max_entries,
+                                     ttl=config.cache_ttl_seconds,
+                                     policy=config.cache_policy)
+
+
+
+def new_differ():
+    "Frame differencing stage of a stream or video job using `motion`"
+    return FrameDiffer(threshold=config.motion_threshold,
+                       min_changed=config.motion_min_changed,
+                       width=config.motion_width,
+                       roi=config.motion_roi,
+                       roi_max_area=config.motion_roi_max_area,
+                       max_skip=config.motion_max_skip)
+
+
+# background processing of video files, through the same detector
+video_jobs = VideoJobManager(
+    detector,
+    lambda image, bbox, label, conf: od_model.draw_bbox(
+        image, bbox, label, conf, write_conf=True),
+    config.video_dir,
+    nms_thresh=config.nms_thresh,
+    workers=config.video_job_workers,
+    max_in_flight=2 * config.batch_max_size,
+    differ_factory=new_differ,
+    max_jobs=config.video_max_jobs,
+    ttl=config.video_job_ttl_seconds)
+
+# open /stream connections, only touched from the event loop
+active_streams = 0
+
+# Optionally keep a copy of the annotated images on disk
+audit_sink = None
+if config.audit_images:
+    utils.ensure_upload_dir(config.upload_dir)
+    audit_sink = AuditSink(config.upload_dir,
+                           max_files=config.audit_max_files)
 
 # Optionally configure prometheus metrics route
 if config.prometheus_metrics:
@@ -77,74 +172,734 @@ class TracingDeps:
         self.tracer = trace.get_tracer(config.service_name)
 
 
+# set once the in-process models are loaded and warmed up
+models_ready = threading.Event()
+
+
+def warm_up():
+    "Load and warm up every configured model"
+    try:
+        od_model.preload(config.preload_models)
+        timings = od_model.warmup(config.preload_models,
+                                  config.warmup_iterations)
+    except Exception as e:
+        console.log(f"[red]Model warm-up failed: {e!r}[/]")
+        return
+    for model, elapsed in timings.items():
+        console.log(f"[green]Warmed up {model} in {sum(elapsed):0.3f}s[/]")
+    models_ready.set()
+
+
+def is_ready():
+    "Whether the models are loaded and warmed up"
+    if config.inference_mode == "process":
+        return detector.is_ready()
+    return models_ready.is_set()
+
+
+@app.on_event("startup")
+def load_models():
+    """Load and warm up every configured model in the background,
+    so that `/health` answers while `/ready` reports the progress."""
+    console.log(f"Preloading models: {config.preload_models}")
+    if config.inference_mode == "process":
+        detector.start()
+    else:
+        threading.Thread(target=warm_up, name="yoso-warmup",
+                         daemon=True).start()
+
+
+@app.on_event("shutdown")
+def stop_workers():
+    if config.inference_mode == "process":
+        detector.stop()
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request, exc: Overloaded):
+    "Reject requests the inference executor cannot admit"
+    return JSONResponse(
+        content={"detail": "Server overloaded, retry later."},
+        status_code=503,
+        headers={"Retry-After": str(config.retry_after_seconds)})
+
+
 ## Define routes
+# control endpoints are async so they never wait on a threadpool thread
 @app.get("/")
-def home():
+async def home():
     return HTMLResponse(content=welcome_page, status_code=200)
 
 
+@app.get("/health")
+async def health():
+    "Liveness probe"
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready():
+    "Readiness probe, 503 until the models are loaded and warmed up"
+    if not is_ready():
+        return JSONResponse(content={"status": "warming up"},
+                            status_code=503)
+    return {"status": "ready"}
+
+
+@app.get("/models", response_model=ModelsResponse)
+async def models():
+    """Report load time and memory of the loaded models. In process mode,
+    those of the worker processes (the server process loads none)."""
+    if config.inference_mode == "process":
+        return ModelsResponse(models=detector.stats(),
+                              workers={
+                                  str(worker_id): stats
+                                  for worker_id, stats in list(
+                                      detector.worker_stats.items())
+                              })
+    return ModelsResponse(models=od_model.registry.stats())
+
+
+def network_size(model: Model, input_size: Optional[InputSize]):
+    "Network input size of a request, the model's own when not given"
+    return od_model.input_size(
+        model.value, None if input_size is None else int(input_size))
+
+
+def decode_and_lookup(content: bytes, model: Model, confidence: float,
+                      need_image: bool, size: int):
+    """Decode an uploaded image and look its detections up in the cache.
+
+    On a cache hit the image is only decoded if `need_image`.
+    Returns the decoded image (or None), the cache key and the cached
+    detections (or None).
+    """
+    key, detections = None, None
+    if detection_cache is not None:
+        key = detection_cache.key(content, model.value, config.nms_thresh,
+                                  size)
+        detections = detection_cache.lookup(key, confidence, model.value)
+
+    image = None
+    if detections is None or need_image:
+        with stage_timer("decode", model.value):
+            image, _ = decode_image(content, config.decode_reduce_to)
+        if image is None:
+            raise HTTPException(status_code=400,
+                                detail="Could not decode the image.")
+    return image, key, detections
+
+
+async def wait_detections(future):
+    """Await the detections of a detector `future`, failing with a 504
+    after `inference_timeout_seconds` (the future is then cancelled)"""
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future),
+                                      config.inference_timeout_seconds
+                                      or None)
+    except (asyncio.TimeoutError, TimeoutError):
+        raise HTTPException(status_code=504, detail="Inference timed out.")
+
+
+async def detect_content(content: bytes,
+                         model: Model,
+                         confidence: float,
+                         tracing: TracingDeps,
+                         need_image: bool = True,
+                         input_size: Optional[InputSize] = None):
+    """Decode an uploaded image and run object detection on it, with the
+    network fed at `input_size`.
+
+    Decoding runs on the inference executor, the detection itself is
+    awaited on the detector's future without holding any thread.
+    The image is validated first (see `utils.validate_image_content`).
+    Returns the decoded image (or None) and the (bbox, label, conf) detections.
+    """
+    utils.validate_image_content(content, config.max_upload_bytes,
+                                 config.max_image_pixels)
+    size = network_size(model, input_size)
+    image, key, detections = await executor.run(decode_and_lookup, content,
+                                                 model, confidence,
+                                                 need_image, size)
+    if detections is not None:
+        observe_detections(model.value, detections[1])
+        return image, detections
+
+    # cached detections are computed at a lower floor, to serve any confidence
+    floor = confidence
+    if detection_cache is not None:
+        floor = min(confidence, config.cache_min_confidence)
+
+    with tracing.tracer.start_as_current_span("cv-model"):
+        detections = await wait_detections(
+            detector.submit(image,
+                            model=model,
+                            confidence=floor,
+                            nms_thresh=config.nms_thresh,
+                            size=size))
+
+    if detection_cache is not None:
+        detection_cache.store(key, floor, detections)
+        detections = detection_cache.filter(detections, confidence)
+
+    observe_detections(model.value, detections[1])
+    return image, detections
+
+
+def annotate(model: Model,
+             image,
+             bbox,
+             label,
+             conf,
+             max_dim=None,
+             image_format=ImageFormat.jpeg,
+             quality=None):
+    """Draw the detections of `model` on `image`, downscaled to a long side
+    of at most `max_dim` if set, and encode it as `image_format` at
+    `quality` (default: the configured one)"""
+    with stage_timer("draw", model.value):
+        output_image = od_model.draw_bbox(image,
+                                          bbox,
+                                          label,
+                                          conf,
+                                          write_conf=True,
+                                          max_dim=max_dim)
+    if quality is None:
+        quality = (config.webp_quality if image_format == ImageFormat.webp
+                   else config.jpeg_quality)
+    with stage_timer("encode", model.value):
+        encoded = encode(output_image, image_format.value, quality)
+    if encoded is None:
+        raise HTTPException(status_code=500,
+                            detail="Could not encode the annotated image.")
+    return encoded
+
+
 # This endpoint handles all the logic necessary for the object detection to work.
 # It requires the desired model and the image in which to perform object detection.
 @app.post("/predict", summary="Perform object detection.")
-def prediction(model: Model,
-               confidence: float = 0.5,
-               file: UploadFile = File(...),
-               tracing: TracingDeps = Depends(TracingDeps)):
+async def prediction(model: Model,
+                     confidence: float = 0.5,
+                     input_size: Optional[InputSize] = None,
+                     max_dim: Optional[int] = Query(None, ge=32),
+                     image_format: ImageFormat = ImageFormat.jpeg,
+                     quality: Optional[int] = Query(None, ge=1, le=100),
+                     file: UploadFile = File(...),
+                     tracing: TracingDeps = Depends(TracingDeps)):
 
     # 1. VALIDATE INPUT FILE
     utils.validate_image_file(file)
+    utils.validate_upload_size(file, config.max_upload_bytes)
 
-    # 2. TRANSFORM RAW IMAGE INTO CV2 image
-    image = file_to_cv_image(file)
-
-    # 3. RUN OBJECT DETECTION MODEL
-
-    with tracing.tracer.start_as_current_span("cv-model"):
-        bbox, label, conf = od_model.detect_common_objects(
-            image,
-            model=model,
-            # extra, pass the confidence level
-            confidence=confidence)
+    async with executor.admit():
+        content = await executor.run(upload_bytes, file)
 
-    # Create image that includes bounding boxes and labels
-    output_image = od_model.draw_bbox(image,
-                                      bbox,
-                                      label,
-                                      conf,
-                                      write_conf=True)
+        # 2. TRANSFORM RAW IMAGE INTO CV2 image AND RUN OBJECT DETECTION MODEL
+        image, (bbox, label, conf) = await detect_content(
+            content, model, confidence, tracing, input_size=input_size)
 
-    img_path = os.path.join(config.upload_dir, file.filename)
-    # Save it in a folder within the server
-    cv2.imwrite(img_path, output_image)
+        # 3. CREATE AND ENCODE THE IMAGE WITH BOUNDING BOXES AND LABELS
+        content = await executor.run(annotate, model, image, bbox, label,
+                                     conf, max_dim, image_format, quality)
 
-    # 4. STREAM THE RESPONSE BACK TO THE CLIENT
+    extension, media_type, _ = FORMATS[image_format.value]
+    if audit_sink is not None:
+        audit_sink.submit(
+            os.path.splitext(file.filename)[0] + extension, content)
 
-    # Open the saved image for reading in binary mode
-    file_image = open(img_path, mode="rb")
-
-    # Return the image as a stream specifying media type
-    return StreamingResponse(file_image, media_type="image/jpeg")
+    # 4. SEND THE RESPONSE BACK TO THE CLIENT
+    return Response(content=content, media_type=media_type)
 
 
 @app.post("/count_objects", response_model=CounterResponse)
-def count_objects(model: Model,
-                  confidence: float = 0.5,
-                  file: UploadFile = File(...),
-                  tracing: TracingDeps = Depends(TracingDeps)):
+async def count_objects(model: Model,
+                        confidence: float = 0.5,
+                        input_size: Optional[InputSize] = None,
+                        file: UploadFile = File(...),
+                        tracing: TracingDeps = Depends(TracingDeps)):
     # 1. VALIDATE INPUT FILE
     utils.validate_image_file(file)
+    utils.validate_upload_size(file, config.max_upload_bytes)
 
-    # 2. TRANSFORM RAW IMAGE INTO CV2 image
-    image = file_to_cv_image(file)
+    async with executor.admit():
+        content = await executor.run(upload_bytes, file)
 
-    with tracing.tracer.start_as_current_span("cv-model"):
-        # 3. RUN OBJECT DETECTION MODEL
-        _, label, _ = od_model.detect_common_objects(
-            image,
-            model=model,
-            # extra, pass the confidence level
-            confidence=confidence)
+        # 2. TRANSFORM RAW IMAGE INTO CV2 image AND RUN OBJECT DETECTION MODEL
+        _, (_, label, _) = await detect_content(content,
+                                                model,
+                                                confidence,
+                                                tracing,
+                                                need_image=False,
+                                                input_size=input_size)
 
     c = Counter(label)
 
     return CounterResponse(items=dict(c))
+
+
+def to_image_detections(filename, bbox, label, conf):
+    "Pack the detections of one image into its API model"
+    return ImageDetections(
+        filename=filename,
+        detections=[
+            Detection(label=l, confidence=c, box=b)
+            for b, l, c in zip(bbox, label, conf)
+        ],
+        items=dict(Counter(label)))
+
+
+def annotated_archive(response: BatchPredictionResponse,
+                      images,
+                      max_dim=None,
+                      image_format=ImageFormat.jpeg,
+                      quality=None):
+    """Zip archive of the annotated images of a batch (see `annotate`),
+    together with the JSON detections document as `detections.json`"""
+    extension = FORMATS[image_format.value][0]
+    buf = io.BytesIO()
+    names = set()
+    # the images are already compressed: store them as they are
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as archive:
+        for i, (result, image) in enumerate(zip(response.results, images)):
+            if image is None:
+                continue
+            name = os.path.splitext(result.filename)[0] + extension
+            if name in names:
+                name = f"{i}-{name}"
+            names.add(name)
+            bbox = [d.box for d in result.detections]
+            label = [d.label for d in result.detections]
+            conf = [d.confidence for d in result.detections]
+            archive.writestr(
+                name,
+                annotate(response.model, image, bbox, label, conf, max_dim,
+                         image_format, quality))
+        archive.writestr("detections.json", response.json())
+    return buf.getvalue()
+
+
+@app.post("/predict_batch",
+          response_model=BatchPredictionResponse,
+          summary="Perform object detection on many images.")
+async def predict_batch(model: Model,
+                        confidence: float = 0.5,
+                        annotated: bool = False,
+                        input_size: Optional[InputSize] = None,
+                        max_dim: Optional[int] = Query(None, ge=32),
+                        image_format: ImageFormat = ImageFormat.jpeg,
+                        quality: Optional[int] = Query(None, ge=1, le=100),
+                        files: List[UploadFile] = File(...),
+                        tracing: TracingDeps = Depends(TracingDeps)):
+    """Run object detection on several images, uploaded as multiple files
+    and/or zip/tar archives of images. Concurrent images are batched into
+    shared forward passes by the detector.
+
+    Returns per-image detections as JSON or, when `annotated`, a zip archive
+    of the annotated images plus `detections.json`, rendered as by `/predict`.
+    """
+    # 1. VALIDATE INPUT FILES, BEFORE READING ANY
+    for file in files:
+        utils.validate_batch_file(file)
+        utils.validate_upload_size(
+            file, config.batch_max_bytes
+            if utils.is_archive(file.filename) else config.max_upload_bytes)
+
+    def remaining(limit, used):
+        "What is left of a limit (0: none) of the batch, None if unlimited"
+        return limit - used if limit > 0 else None
+
+    async with executor.admit():
+        # 2. COLLECT THE IMAGES, EXPANDING ARCHIVES WITHIN THE LIMITS
+        uploads = []
+        total_bytes = 0
+        for file in files:
+            content = await executor.run(upload_bytes, file)
+            if utils.is_archive(file.filename):
+                images = await executor.run(
+                    utils.expand_archive,
+                    file.filename,
+                    content,
+                    max_images=remaining(config.batch_max_images,
+                                         len(uploads)),
+                    max_image_bytes=config.max_upload_bytes or None,
+                    max_total_bytes=remaining(config.batch_max_bytes,
+                                              total_bytes))
+            else:
+                images = [(file.filename, content)]
+            # the archive itself is released once expanded
+            del content
+            uploads.extend(images)
+            total_bytes += sum(len(image) for _, image in images)
+
+            if 0 < config.batch_max_images < len(uploads):
+                raise utils.reject(
+                    413, "too_many_images",
+                    f"At most {config.batch_max_images} images per batch.")
+            if 0 < config.batch_max_bytes < total_bytes:
+                raise utils.reject(
+                    413, "too_large",
+                    f"Batches are limited to {config.batch_max_bytes} bytes.")
+
+        # 3. RUN OBJECT DETECTION ON ALL OF THEM CONCURRENTLY
+        async def detect_one(filename, content):
+            try:
+                image, detections = await detect_content(
+                    content,
+                    model,
+                    confidence,
+                    tracing,
+                    need_image=annotated,
+                    input_size=input_size)
+            except HTTPException as e:
+                return None, ImageDetections(filename=filename,
+                                             error=e.detail)
+            return image, to_image_detections(filename, *detections)
+
+        outcomes = await asyncio.gather(
+            *[detect_one(name, content) for name, content in uploads])
+
+        response = BatchPredictionResponse(
+            model=model, results=[result for _, result in outcomes])
+
+        if not annotated:
+            return response
+
+        # 4. OPTIONALLY SEND BACK THE ANNOTATED IMAGES
+        content = await executor.run(annotated_archive, response,
+                                     [image for image, _ in outcomes],
+                                     max_dim, image_format, quality)
+
+    return Response(content=content,
+                    media_type="application/zip",
+                    headers={
+                        "Content-Disposition":
+                        'attachment; filename="predictions.zip"'
+                    })
+
+
+# media types of the compact /detect encodings
+PACKED_MEDIA_TYPE = "application/octet-stream"
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+
+def encode_detections(response: DetectionResponse, accept: str):
+    """Encode a /detect response according to the `Accept` header.
+
+    - `application/octet-stream`: little endian float32 array of N rows
+      (x1, y1, x2, y2, confidence, class id), image size in the
+      `X-Yoso-Width` and `X-Yoso-Height` headers
+    - `application/x-msgpack`: the JSON document, packed with msgpack
+    - anything else: the JSON document
+    """
+    if PACKED_MEDIA_TYPE in accept:
+        detections = response.detections
+        class_ids = od_model.class_ids([d.label for d in detections])
+        packed = np.array([
+            d.box + [d.confidence, class_id]
+            for d, class_id in zip(detections, class_ids)
+        ],
+                          dtype="<f4").reshape(-1, 6)
+        return Response(content=packed.tobytes(),
+                        media_type=PACKED_MEDIA_TYPE,
+                        headers={
+                            "X-Yoso-Width": str(response.width),
+                            "X-Yoso-Height": str(response.height)
+                        })
+    if MSGPACK_MEDIA_TYPE in accept:
+        if msgpack is None:
+            raise HTTPException(status_code=406,
+                                detail="msgpack encoding is not available.")
+        return Response(content=msgpack.packb(response.dict()),
+                        media_type=MSGPACK_MEDIA_TYPE)
+    return response
+
+
+async def detect_boxes(content: bytes,
+                       model: Model,
+                       confidence: float,
+                       tracing: TracingDeps,
+                       input_size: Optional[InputSize] = None):
+    """Run object detection on an encoded image, returning its size and the
+    detections in its coordinates. The image is only decoded if its header
+    does not tell its size (and the detections are not cached)."""
+    dims = image_size(content)
+    image, (bbox, label, conf) = await detect_content(content,
+                                                      model,
+                                                      confidence,
+                                                      tracing,
+                                                      need_image=dims is None,
+                                                      input_size=input_size)
+
+    # map boxes back from a reduced decode to the uploaded image
+    if dims is None:
+        height, width = image.shape[:2]
+    else:
+        width, height = dims
+        _, factor = reduced_read_flag(dims, config.decode_reduce_to)
+        bbox = scale_boxes(bbox, factor, factor)
+    return width, height, (bbox, label, conf)
+
+
+@app.post("/detect",
+          response_model=DetectionResponse,
+          summary="Perform object detection, returning the boxes.")
+async def detect(model: Model,
+                 confidence: float = 0.5,
+                 input_size: Optional[InputSize] = None,
+                 orig_width: Optional[int] = Query(None, ge=1),
+                 orig_height: Optional[int] = Query(None, ge=1),
+                 file: UploadFile = File(...),
+                 accept: str = Header("application/json"),
+                 tracing: TracingDeps = Depends(TracingDeps)):
+    """Return the boxes, labels and confidences of the detected objects,
+    in the coordinates of the uploaded image, or of the original image it
+    was downscaled from by the client when `orig_width` and `orig_height`
+    are given. The encoding is selected via the `Accept` header, see
+    `encode_detections`."""
+    if (orig_width is None) != (orig_height is None):
+        raise HTTPException(
+            status_code=400,
+            detail="orig_width and orig_height must be given together.")
+    # 1. VALIDATE INPUT FILE
+    utils.validate_image_file(file)
+    utils.validate_upload_size(file, config.max_upload_bytes)
+
+    async with executor.admit():
+        content = await executor.run(upload_bytes, file)
+
+        # 2. RUN OBJECT DETECTION MODEL
+        width, height, (bbox, label, conf) = await detect_boxes(
+            content, model, confidence, tracing, input_size)
+
+    if orig_width is not None:
+        bbox = scale_boxes(bbox, orig_width / width, orig_height / height)
+        width, height = orig_width, orig_height
+
+    response = DetectionResponse(model=model,
+                                 width=width,
+                                 height=height,
+                                 detections=to_image_detections(
+                                     file.filename, bbox, label,
+                                     conf).detections)
+
+    return encode_detections(response, accept)
+
+
+def decode_and_diff(content: bytes, differ: FrameDiffer, model: Model):
+    "Decode a stream frame and decide how to run detection on it"
+    with stage_timer("decode", model.value):
+        image, factor = decode_image(content, config.decode_reduce_to)
+    if image is None:
+        raise HTTPException(status_code=400,
+                            detail="Could not decode the image.")
+    return image, factor, differ.decide(image)
+
+
+async def detect_changes(differ: FrameDiffer,
+                         content: bytes,
+                         model: Model,
+                         confidence: float,
+                         tracing: TracingDeps,
+                         input_size: Optional[InputSize] = None):
+    """Run object detection on a stream frame as decided by `differ`: reuse
+    the last detections, detect on the changed region only, or on the whole
+    frame. Returns the frame size, the detections and the decision."""
+    utils.validate_image_content(content, config.max_upload_bytes,
+                                 config.max_image_pixels)
+    image, factor, (decision, roi) = await executor.run(
+        decode_and_diff, content, differ, model)
+
+    detections = None
+    if decision != "skip":
+        target = image if roi is None else differ.crop(image, roi)
+        with tracing.tracer.start_as_current_span("cv-model"):
+            detections = await wait_detections(
+                detector.submit(target,
+                                model=model,
+                                confidence=confidence,
+                                nms_thresh=config.nms_thresh,
+                                size=network_size(model, input_size)))
+    bbox, label, conf = differ.resolve(decision, roi, detections)
+    observe_detections(model.value, label)
+
+    height, width = image.shape[:2]
+    bbox = scale_boxes(bbox, factor, factor)
+    return (width * factor, height * factor), (bbox, label, conf), decision
+
+
+@app.websocket("/stream")
+async def stream(websocket: WebSocket,
+                 model: Model,
+                 confidence: float = 0.5,
+                 motion: bool = False,
+                 input_size: Optional[InputSize] = None,
+                 tracing: TracingDeps = Depends(TracingDeps)):
+    """Run object detection on a stream of frames.
+
+    The client sends each encoded frame (JPEG or PNG) as a binary message;
+    a `StreamDetections` JSON message is sent back for every processed frame.
+    When inference falls behind, pending frames are dropped in favour of
+    the newest one (see `yoso.streaming`). With `motion`, frames that did
+    not change reuse the last detections (see `yoso.motion`).
+    """
+    global active_streams
+    if active_streams >= config.stream_max_connections:
+        REQUESTS_REJECTED.labels(reason="streams").inc()
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    await websocket.accept()
+    active_streams += 1
+    STREAM_CONNECTIONS.inc()
+
+    mailbox = LatestFrame()
+    differ = new_differ() if motion else None
+
+    async def receive():
+        seq = 0
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is not None:
+                    mailbox.put(seq, message["bytes"])
+                    seq += 1
+        finally:
+            mailbox.close()
+
+    receiver = asyncio.create_task(receive())
+    try:
+        while True:
+            frame = await mailbox.get()
+            if frame is None:
+                break
+            seq, content = frame
+            decision = None
+            try:
+                if differ is None:
+                    width, height, (bbox, label, conf) = await detect_boxes(
+                        content, model, confidence, tracing, input_size)
+                else:
+                    (width, height), (bbox, label, conf), decision = \
+                        await detect_changes(differ, content, model,
+                                             confidence, tracing, input_size)
+            except HTTPException as e:
+                result = StreamDetections(frame=seq,
+                                          dropped=mailbox.dropped,
+                                          error=e.detail)
+            else:
+                STREAM_FRAMES.labels(outcome="processed").inc()
+                result = StreamDetections(
+                    frame=seq,
+                    dropped=mailbox.dropped,
+                    width=width,
+                    height=height,
+                    detections=[
+                        Detection(label=l, confidence=c, box=b)
+                        for b, l, c in zip(bbox, label, conf)
+                    ],
+                    decision=decision)
+            await websocket.send_text(result.json())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        active_streams -= 1
+        STREAM_CONNECTIONS.dec()
+
+
+def get_video_job(job_id: str):
+    job = video_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown video job.")
+    return job
+
+
+@app.post("/video_jobs",
+          response_model=VideoJobStatus,
+          status_code=202,
+          summary="Run object detection on a video file in the background.")
+async def create_video_job(model: Model,
+                           confidence: float = 0.5,
+                           every_n: int = Query(1, ge=1),
+                           target_fps: Optional[float] = Query(None, gt=0),
+                           annotated: bool = False,
+                           motion: bool = False,
+                           input_size: Optional[InputSize] = None,
+                           path: Optional[str] = None,
+                           file: Optional[UploadFile] = File(None)):
+    """Process an uploaded video, or a video under `YOSO_video_input_dir`
+    given by its `path`. One frame every `every_n` (or the closest to
+    `target_fps`) is run through detection; poll `/video_jobs/{id}` for
+    progress, then fetch `/video_jobs/{id}/detections` (JSON lines) and,
+    when `annotated`, `/video_jobs/{id}/video`. With `motion`, sampled
+    frames that did not change reuse the previous detections."""
+    if (file is None) == (path is None):
+        raise HTTPException(
+            status_code=400,
+            detail="Provide either an uploaded file or a local path.")
+
+    if file is not None:
+        utils.validate_image_file(file, utils.VIDEO_EXTS)
+        source = video_jobs.upload_path(file.filename)
+        await executor.run(utils.save_upload, file, source)
+        name, cleanup = file.filename, True
+    else:
+        source = utils.resolve_local_file(path, config.video_input_dir)
+        utils.validate_filename(source, utils.VIDEO_EXTS)
+        name, cleanup = path, False
+
+    job = video_jobs.create(source,
+                            model,
+                            confidence=confidence,
+                            every_n=every_n,
+                            target_fps=target_fps,
+                            annotated=annotated,
+                            name=name,
+                            cleanup=cleanup,
+                            motion=motion,
+                            size=network_size(model, input_size))
+    return VideoJobStatus(**job.summary())
+
+
+@app.get("/video_jobs", response_model=VideoJobsResponse)
+async def list_video_jobs():
+    return VideoJobsResponse(
+        jobs=[VideoJobStatus(**job.summary()) for job in video_jobs.list()])
+
+
+@app.get("/video_jobs/{job_id}", response_model=VideoJobStatus)
+async def video_job_status(job_id: str):
+    "Status, progress and throughput of a video job"
+    return VideoJobStatus(**get_video_job(job_id).summary())
+
+
+@app.delete("/video_jobs/{job_id}", status_code=204)
+async def delete_video_job(job_id: str):
+    "Delete a finished video job and its outputs"
+    job = get_video_job(job_id)
+    if job.finished is None:
+        raise HTTPException(status_code=409,
+                            detail="The video job is not finished yet.")
+    await executor.run(video_jobs.remove, job)
+    return Response(status_code=204)
+
+
+@app.get("/video_jobs/{job_id}/detections")
+async def video_job_detections(job_id: str):
+    "Per-frame detections written so far, as JSON lines"
+    job = get_video_job(job_id)
+    if not os.path.exists(job.detections_path):
+        raise HTTPException(status_code=404, detail="No detections yet.")
+    return FileResponse(job.detections_path,
+                        media_type="application/x-ndjson")
+
+
+@app.get("/video_jobs/{job_id}/video")
+async def video_job_video(job_id: str):
+    "Annotated video of the sampled frames, once the job is done"
+    job = get_video_job(job_id)
+    if job.video_path is None or job.status != "done":
+        raise HTTPException(status_code=404,
+                            detail="No annotated video available.")
+    return FileResponse(job.video_path, media_type="video/x-msvideo")
@@ -1,18 +1,179 @@
 import io
+import struct
 import numpy as np
 import cv2
 import cvlib as cv
 from fastapi import UploadFile
 
+# IMREAD flags decoding directly at a fraction of the full resolution
+REDUCED_READ_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
 
-def file_to_cv_image(file: UploadFile):
-    """Convert raw image file to cv2 image"""
 
-    image_stream = io.BytesIO(
-        file.file.read())  # Read image as a stream of bytes
-    image_stream.seek(0)
-    # Write the stream of bytes into a numpy array
-    file_bytes = np.asarray(bytearray(image_stream.read()), dtype=np.uint8)
-    # Decode the numpy array as an image
+# leading bytes of the accepted image formats
+MAGIC_BYTES = {
+    "jpeg": b"\xff\xd8\xff",
+    "png": b"\x89PNG\r\n\x1a\n",
+}
+
+
+def image_format(buf):
+    "Sniff the format of an encoded image from its magic bytes, or None"
+    head = bytes(memoryview(buf)[:8])
+    for name, magic in MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def jpeg_segments(data):
+    """Walk the segments of a JPEG image up to its start of frame, yielding
+    their (marker, offset, length); stops at the first malformed one"""
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            # standalone markers, without a length field
+            i += 2
+            continue
+        (length, ) = struct.unpack(">H", data[i + 2:i + 4])
+        yield marker, i, length
+        if is_sof(marker):
+            return
+        i += 2 + length
+
+
+def is_sof(marker):
+    "Whether `marker` is a JPEG start of frame (SOFn)"
+    return 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC)
+
+
+def header_size(buf):
+    """Read the (width, height) stored in the header of a JPEG or PNG image,
+    without decoding it. Returns None for other or malformed inputs."""
+    data = memoryview(buf)
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:2] != b"\xff\xd8":
+        return None
+    for marker, i, _ in jpeg_segments(data):
+        if is_sof(marker):
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+    return None
+
+
+def jpeg_orientation(buf):
+    """The EXIF orientation (1-8) of a JPEG image, or None if it has none"""
+    data = memoryview(buf)
+    if data[:2] != b"\xff\xd8":
+        return None
+    for marker, i, length in jpeg_segments(data):
+        if marker != 0xE1 or data[i + 4:i + 10] != b"Exif\x00\x00":
+            continue
+        # TIFF header, then the first image file directory (IFD0)
+        tiff = data[i + 10:i + 2 + length]
+        order = {b"II": "<", b"MM": ">"}.get(bytes(tiff[:2]))
+        if order is None:
+            return None
+        try:
+            (ifd, ) = struct.unpack(order + "I", tiff[4:8])
+            (entries, ) = struct.unpack(order + "H", tiff[ifd:ifd + 2])
+            for k in range(entries):
+                entry = ifd + 2 + 12 * k
+                (tag, ) = struct.unpack(order + "H", tiff[entry:entry + 2])
+                if tag == 0x0112:
+                    (value, ) = struct.unpack(order + "H",
+                                              tiff[entry + 8:entry + 10])
+                    return value
+        except struct.error:
+            return None
+        return None
+    return None
+
+
+def image_size(buf):
+    """Read the (width, height) of a JPEG or PNG image as decoded by
+    `cv2.imdecode`, without decoding it: the header size, transposed for
+    the EXIF orientations (5 to 8) rotating JPEGs by 90 degrees, which
+    OpenCV applies. Returns None for other or malformed inputs."""
+    size = header_size(buf)
+    if size is not None and (jpeg_orientation(buf) or 1) >= 5:
+        width, height = size
+        return height, width
+    return size
+
 
-    return cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+def reduced_read_flag(size, reduce_to):
+    """Pick the IMREAD flag decoding an image of `size` (width, height) at the
+    largest power of two reduction keeping its short side >= `reduce_to`.
+    Returns the flag and the reduction factor."""
+    if reduce_to > 0 and size is not None:
+        short_side = min(size)
+        for factor, flag in REDUCED_READ_FLAGS.items():
+            if short_side >= reduce_to * factor:
+                return flag, factor
+    return cv2.IMREAD_COLOR, 1
+
+
+def decode_image(buf, reduce_to=0):
+    """Decode an encoded image from any bytes-like `buf` without copying it.
+
+    When `reduce_to` is set, images much larger than needed are decoded
+    directly at 1/2, 1/4 or 1/8 of their resolution (see `reduced_read_flag`).
+    Returns the image and the reduction factor applied to it.
+    """
+    flag, factor = reduced_read_flag(
+        image_size(buf) if reduce_to > 0 else None, reduce_to)
+    data = np.frombuffer(buf, dtype=np.uint8)
+    image = cv2.imdecode(data, flag)
+    # drop the export on `buf` before returning, so it can be released
+    del data
+    return image, factor
+
+
+def scale_boxes(bbox, sx, sy):
+    """Scale [x1, y1, x2, y2] boxes by `sx` horizontally and `sy` vertically"""
+    if sx == 1 and sy == 1:
+        return bbox
+    return [[
+        int(round(x1 * sx)),
+        int(round(y1 * sy)),
+        int(round(x2 * sx)),
+        int(round(y2 * sy))
+    ] for x1, y1, x2, y2 in bbox]
+
+
+def upload_bytes(file: UploadFile) -> bytes:
+    """The content of an upload, as bytes.
+
+    Small uploads are spooled in memory: `BytesIO.getvalue` hands out its
+    own buffer instead of copying it (unlike `read`). Uploads rolled over to
+    disk are read once. Blocks on the disk: run it off the event loop.
+    """
+    spooled = file.file
+    inner = getattr(spooled, "_file", spooled)
+    if isinstance(inner, io.BytesIO):
+        return inner.getvalue()
+    spooled.seek(0)
+    return spooled.read()
+
+
+def decode_upload(file: UploadFile, reduce_to=0):
+    """Decode an uploaded image file, see `decode_image`"""
+    return decode_image(upload_bytes(file), reduce_to)
+
+
+def file_to_cv_image(file: UploadFile, reduce_to=0):
+    """Convert raw image file to cv2 image"""
+    image, _ = decode_upload(file, reduce_to)
+    return image
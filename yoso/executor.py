@@ -0,0 +1,56 @@
+"""
+Bounded offloading of the CPU work of the inference endpoints.
+
+The inference handlers are `async`: they await the upload read on the
+event loop and run decoding, drawing and encoding on a dedicated thread
+pool, instead of holding one of Starlette's threadpool threads for the
+whole request. Admission is bounded: once `max_workers + max_queue`
+requests are in flight, new ones are rejected right away with `Overloaded`
+so that the control endpoints (`/`, `/health`, `/metrics`...) stay responsive.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from yoso.prometheus import REQUESTS_REJECTED, REQUESTS_IN_FLIGHT
+
+
+class Overloaded(Exception):
+    "Raised when the inference executor or worker pool cannot admit requests"
+
+
+class InferenceExecutor:
+    """A dedicated thread pool with bounded admission.
+
+    `admit` and `run` must be called from the event loop.
+    """
+
+    def __init__(self, max_workers: int = 4, max_queue: int = 16):
+        assert max_workers >= 1, "max_workers must be at least 1"
+        self.pool = ThreadPoolExecutor(max_workers=max_workers,
+                                       thread_name_prefix="yoso-inference")
+        self.capacity = max_workers + max_queue
+        # only touched from the event loop thread, no lock needed
+        self.admitted = 0
+        REQUESTS_IN_FLIGHT.set_function(lambda: self.admitted)
+
+    @asynccontextmanager
+    async def admit(self):
+        "Reserve a slot for a request, raises `Overloaded` when full"
+        if self.admitted >= self.capacity:
+            REQUESTS_REJECTED.labels(reason="overloaded").inc()
+            raise Overloaded()
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.admitted -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        "Run `fn` on the pool, propagating context vars (e.g. tracing spans)"
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self.pool, functools.partial(ctx.run, fn, *args, **kwargs))
@@ -0,0 +1,167 @@
+"""
+Local store of the model artifacts (darknet cfg/weights and class labels).
+
+Files are resolved from a configurable directory. Missing files are
+downloaded, unless downloads are disabled, in which case they must have
+been fetched ahead of time (e.g. at image build time, with
+`python -m yoso.cli fetch-models`) so that no request ever blocks on one.
+
+Files are verified against their SHA-256 when one is known: from the
+`checksums` given to the store, from the `SHA256SUMS` manifest shipped next
+to this module (the known-good hashes of the upstream files), or from a
+`SHA256SUMS` manifest in the directory (`sha256sum` format), in that order.
+Verification streams the file once per process; networks are then read from
+their path, each replica holding its own copy of the weights.
+"""
+import hashlib
+import os
+import threading
+
+from cvlib.utils import download_file
+
+from yoso.console import console
+
+MANIFEST = "SHA256SUMS"
+MANIFEST_HEADER = (
+    "# SHA-256 of the upstream model files (sha256sum format), checked by\n"
+    "# `python -m yoso.cli fetch-models` (so by the Docker build) and on load.\n"
+    "# Add missing ones with `fetch-models --write-checksums` on a trusted\n"
+    "# download, and review the diff.\n")
+# header of the manifests recording the hashes of unpinned downloads
+DOWNLOAD_MANIFEST_HEADER = (
+    "# SHA-256 of the model files downloaded here without a pinned one\n"
+    "# (`fetch-models --allow-unpinned`), checked on load.\n")
+# known-good hashes of the upstream model files, committed with the code
+PINNED_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               MANIFEST)
+# cvlib's download directory, used when none is configured
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cvlib",
+                           "object_detection", "yolo", "yolov3")
+
+
+class ChecksumMismatch(Exception):
+    "Raised when a model artifact does not match its expected SHA-256"
+
+
+def sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    "Hex SHA-256 of the file at `path`, read by chunks"
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(path: str):
+    "file name -> SHA-256 listed in the `sha256sum` style manifest at `path`"
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and not parts[0].startswith("#"):
+                    entries[parts[1].lstrip("*")] = parts[0].lower()
+    return entries
+
+
+class ArtifactStore:
+    """Resolve, download and verify the model files under `directory`.
+
+    Args:
+        directory: Where the artifacts are stored
+        checksums: file name -> expected SHA-256, taking precedence over
+            the manifests
+        download: Whether missing files may be downloaded
+        strict: Whether files without a known SHA-256 are rejected
+    """
+
+    def __init__(self,
+                 directory: str,
+                 checksums=None,
+                 download=True,
+                 strict=False):
+        self.directory = directory
+        self.checksums = dict(checksums or {})
+        self.download = download
+        self.strict = strict
+        # (path, size, mtime) of the files already verified by this process
+        self.verified = set()
+        self.lock = threading.Lock()
+
+    def path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name)
+
+    def manifest(self):
+        "file name -> SHA-256 listed in the directory's manifest"
+        return read_manifest(self.path(MANIFEST))
+
+    def expected(self, file_name: str):
+        "Expected SHA-256 of `file_name`, or None if unknown"
+        if file_name in self.checksums:
+            return self.checksums[file_name].lower()
+        pinned = read_manifest(PINNED_MANIFEST).get(file_name)
+        if pinned is not None:
+            return pinned
+        return self.manifest().get(file_name)
+
+    def ensure(self, file_name: str, url: str) -> str:
+        "Path of `file_name`, downloading it from `url` if missing"
+        path = self.path(file_name)
+        if os.path.exists(path):
+            return path
+        if not self.download:
+            raise FileNotFoundError(
+                f"Missing model artifact {path} and downloads are disabled, "
+                "prefetch it with `python -m yoso.cli fetch-models`")
+        with self.lock:
+            if not os.path.exists(path):
+                console.log(f"Downloading {file_name} from {url}")
+                os.makedirs(self.directory, exist_ok=True)
+                download_file(url=url,
+                              file_name=file_name,
+                              dest_dir=self.directory)
+                try:
+                    self.verify(path)
+                except ChecksumMismatch:
+                    os.remove(path)
+                    raise
+        return path
+
+    def verify(self, path: str):
+        """Check `path` against its expected SHA-256, once per process.
+        Files without a known checksum are accepted unless the store is
+        strict."""
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key in self.verified:
+            return
+        expected = self.expected(os.path.basename(path))
+        if expected is None:
+            if self.strict:
+                raise ChecksumMismatch(f"{path} has no known SHA-256")
+        else:
+            digest = sha256(path)
+            if digest != expected:
+                raise ChecksumMismatch(
+                    f"{path} has SHA-256 {digest}, expected {expected}")
+        self.verified.add(key)
+
+    def record_checksums(self,
+                         file_names,
+                         manifest: str = PINNED_MANIFEST,
+                         header: str = MANIFEST_HEADER):
+        """Add the SHA-256 of the listed files that have none to `manifest`
+        (by default the one shipped with the code), pinning them for the
+        next verifications. Only meant to be run on a trusted download,
+        the resulting diff being reviewed like any code change."""
+        entries = read_manifest(manifest)
+        added = [name for name in file_names if self.expected(name) is None]
+        if not added:
+            return []
+        for name in added:
+            entries[name] = sha256(self.path(name))
+        with open(manifest, "w") as f:
+            f.write(header)
+            for name in sorted(entries):
+                f.write(f"{entries[name]}  {name}\n")
+        return added
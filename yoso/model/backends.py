@@ -0,0 +1,125 @@
+"""
+Inference backends of the detection networks.
+
+With the `opencv` runtime the darknet cfg/weights are run by `cv2.dnn`, on
+the configured backend and target (`DNN_BACKENDS`, `DNN_TARGETS`); names
+unknown to the installed OpenCV build, or a backend it was built without
+(e.g. OpenVINO's Inference Engine), fall back to the default backend on CPU.
+
+With the `onnxruntime` runtime an ONNX export of each model is run by
+onnxruntime with all graph optimizations enabled, through `OnnxNet`. The
+export must take the same NCHW RGB blob in [0, 1] as the darknet network
+and produce the same region outputs: rows of (cx, cy, w, h, objectness,
+class scores...) normalized to the input. A quantized (e.g. INT8) export
+can be used the same way. Batched forward passes need an export with a
+dynamic batch axis: one with a static batch size of 1 is run one image at a
+time, and other static batch sizes are rejected.
+"""
+import cv2
+import numpy as np
+
+from yoso.console import console
+
+# optional runtime, only needed with `runtime="onnxruntime"`
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+RUNTIMES = ("opencv", "onnxruntime")
+
+# name -> cv2.dnn constant, looked up lazily as not every build has them all
+DNN_BACKENDS = {
+    "default": "DNN_BACKEND_DEFAULT",
+    "opencv": "DNN_BACKEND_OPENCV",
+    "inference_engine": "DNN_BACKEND_INFERENCE_ENGINE",
+}
+DNN_TARGETS = {
+    "cpu": "DNN_TARGET_CPU",
+    "cpu_fp16": "DNN_TARGET_CPU_FP16",
+}
+
+
+def dnn_preference(backend="default", target="cpu"):
+    """Check that the `backend` and `target` names are supported by the
+    OpenCV build, returning them, or `default` and `cpu` if they are not"""
+    assert backend in DNN_BACKENDS, f"Invalid DNN backend {backend}"
+    assert target in DNN_TARGETS, f"Invalid DNN target {target}"
+    backend_id = getattr(cv2.dnn, DNN_BACKENDS[backend], None)
+    target_id = getattr(cv2.dnn, DNN_TARGETS[target], None)
+    fallback = ("default", "cpu")
+    if backend_id is None or target_id is None:
+        console.log(f"[red]DNN {backend}/{target} is not supported by "
+                    f"OpenCV {cv2.__version__}, using default/cpu[/]")
+        return fallback
+    if (backend == "inference_engine"
+            and not cv2.dnn.getAvailableTargets(backend_id)):
+        console.log("[red]Inference Engine (OpenVINO) backend is not "
+                    "available, using default/cpu[/]")
+        return fallback
+    # targets the hardware lacks (e.g. CPU_FP16 off ARM) are downgraded to
+    # CPU by OpenCV itself, with a warning
+    return backend, target
+
+
+def dnn_ids(backend, target):
+    "OpenCV ids of supported `backend` and `target` names"
+    return (getattr(cv2.dnn, DNN_BACKENDS[backend]),
+            getattr(cv2.dnn, DNN_TARGETS[target]))
+
+
+class OnnxNet:
+    """An onnxruntime session exposing the subset of the `cv2.dnn.Net`
+    interface used by `DetectionModel`"""
+
+    def __init__(self, path, num_threads=None):
+        if ort is None:
+            raise RuntimeError("The onnxruntime runtime requires the "
+                               "`onnxruntime` package")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = (
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"])
+        net_input = self.session.get_inputs()[0]
+        self.input_name = net_input.name
+        # a static batch axis is an int, a dynamic one a name (or None)
+        self.batch_size = (net_input.shape[0] if net_input.shape
+                           and isinstance(net_input.shape[0], int) else None)
+        if self.batch_size not in (None, 1):
+            raise RuntimeError(
+                f"{path} has a static batch size of {self.batch_size}: "
+                "export it with a dynamic batch axis")
+        if self.batch_size == 1:
+            console.log(f"[yellow]{path} has a static batch size of 1, "
+                        "batches run one image at a time[/]")
+        self.blob = None
+
+    def getUnconnectedOutLayersNames(self):
+        return [output.name for output in self.session.get_outputs()]
+
+    def setPreferableBackend(self, backend):
+        "Ignored, onnxruntime runs on its CPU execution provider"
+
+    def setPreferableTarget(self, target):
+        "Ignored, onnxruntime runs on its CPU execution provider"
+
+    def setInput(self, blob):
+        self.blob = blob
+
+    def forward(self, output_names):
+        if self.batch_size is None or len(self.blob) == self.batch_size:
+            return self.session.run(output_names,
+                                    {self.input_name: self.blob})
+        runs = [
+            self.session.run(output_names,
+                             {self.input_name: self.blob[i:i + 1]})
+            for i in range(len(self.blob))
+        ]
+        # stacked as a batched run would have returned them
+        return [
+            np.stack([run[k].reshape(-1, run[k].shape[-1]) for run in runs])
+            for k in range(len(output_names))
+        ]
@@ -0,0 +1,143 @@
+"""
+Dynamic micro-batching in front of `DetectionModel`.
+
+Concurrent requests are queued and collected by a worker thread for up to
+`max_wait` seconds or until `max_batch_size` requests are pending, whichever
+comes first. Each model and input size has its own queue drained by
+`workers` threads (one per network replica): the pending requests are run
+as a single N-image blob through one forward pass, and the results are
+handed back to each waiting caller.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from yoso.model.my_model import DetectionModel
+from yoso.prometheus import BATCH_SIZE, observe_stage
+
+
+class _Request:
+    "A pending detection request waiting to be batched"
+
+    __slots__ = ("image", "confidence", "nms_thresh", "future", "queued")
+
+    def __init__(self, image, confidence, nms_thresh):
+        self.image = image
+        self.confidence = confidence
+        self.nms_thresh = nms_thresh
+        self.future = Future()
+        self.queued = time.perf_counter()
+
+
+class BatchScheduler:
+    """Collect concurrent detection requests into batched forward passes.
+
+    Exposes the same `detect_common_objects` signature as `DetectionModel`
+    so it can be used as a drop-in replacement by the request handlers.
+    """
+
+    def __init__(self,
+                 model: DetectionModel,
+                 max_batch_size: int = 8,
+                 max_wait: float = 0.005,
+                 workers: int = 1):
+        assert max_batch_size >= 1, "max_batch_size must be at least 1"
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.workers = workers
+        # (model name, input size) -> pending requests, each drained by its
+        # own workers: a blob holds images of a single size
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def _queue(self, model, size):
+        "Return the queue of `model` at `size`, starting its workers on first use"
+        key = (model, size)
+        q = self.queues.get(key)
+        if q is None:
+            with self.lock:
+                q = self.queues.get(key)
+                if q is None:
+                    q = queue.Queue()
+                    for i in range(self.workers):
+                        threading.Thread(
+                            target=self._run,
+                            args=(model, size, q),
+                            name=f"yoso-batch-scheduler-{model}-{size}-{i}",
+                            daemon=True).start()
+                    self.queues[key] = q
+        return q
+
+    def submit(self,
+               image,
+               confidence=0.5,
+               nms_thresh=0.3,
+               model='yolov4',
+               size=None):
+        "Enqueue a detection request, returns a `Future` of (bbox, label, conf)"
+        # a bad image would fail the whole batch it ends up in
+        if image is None:
+            raise ValueError("Cannot run detection on an empty image")
+        model = getattr(model, "value", model)
+        # resolved here so that default and explicit sizes share batches
+        size = self.model.input_size(model, size)
+        request = _Request(image, confidence, nms_thresh)
+        self._queue(model, size).put(request)
+        return request.future
+
+    def detect_common_objects(self,
+                              image,
+                              confidence=0.5,
+                              nms_thresh=0.3,
+                              model='yolov4',
+                              size=None):
+        "Blocking detection, see `DetectionModel.detect_common_objects`"
+        return self.submit(image, confidence, nms_thresh, model,
+                           size).result()
+
+    def _collect(self, q):
+        "Block for a first request, then gather more until full or timed out"
+        batch = [q.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, model, size, q):
+        while True:
+            self._run_batch(model, size, self._collect(q))
+
+    def _run_batch(self, model, size, requests):
+        # requests cancelled while queued (e.g. timed out) are skipped, the
+        # others can no longer be cancelled
+        requests = [
+            r for r in requests if r.future.set_running_or_notify_cancel()
+        ]
+        if not requests:
+            return
+        BATCH_SIZE.labels(model=model).observe(len(requests))
+        started = time.perf_counter()
+        for r in requests:
+            observe_stage("queue_wait", model, started - r.queued)
+        try:
+            results = self.model.detect_batch(
+                [r.image for r in requests],
+                [r.confidence for r in requests],
+                [r.nms_thresh for r in requests],
+                model=model,
+                size=size,
+            )
+        except Exception as e:
+            for r in requests:
+                r.future.set_exception(e)
+        else:
+            for r, result in zip(requests, results):
+                r.future.set_result(result)
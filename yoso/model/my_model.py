@@ -1,59 +1,178 @@
 import cv2
-import os
-import numpy as np
-from cvlib.utils import download_file
 import threading
-from functools import wraps
+import time
+import numpy as np
 
+from yoso.model.artifacts import ArtifactStore, DEFAULT_DIR
+from yoso.model.registry import (ModelRegistry, MODEL_SPECS, DEFAULT_MODEL,
+                                 INPUT_SIZES, CLASSES_FILE_NAME, CLASSES_URL)
+from yoso.prometheus import WARMUP_SECONDS, observe_stage
+from yoso.render import Renderer
 
-def locking(method):
+# darknet's letterbox padding colour
+LETTERBOX_FILL = 127
 
-    @wraps(method)
-    def inner(ref, *args, **kwargs):
-        ref.lock.acquire()
-        ret = method(ref, *args, **kwargs)
-        ref.lock.release()
-        return ret
 
-    return inner
+def letterbox_geometry(shape, size):
+    """Fit an image of `shape` (height, width) into a `size` square keeping
+    its aspect ratio. Returns the scale, the resized width and height, and
+    the left and top padding."""
+    height, width = shape
+    r = min(size / width, size / height)
+    new_w, new_h = max(1, round(width * r)), max(1, round(height * r))
+    return r, new_w, new_h, (size - new_w) // 2, (size - new_h) // 2
 
 
-class DetectionModel:
+def letterbox(image, size):
+    "Resize `image` into a padded `size` square, keeping its aspect ratio"
+    _, new_w, new_h, dx, dy = letterbox_geometry(image.shape[:2], size)
+    canvas = np.full((size, size, 3), LETTERBOX_FILL, dtype=np.uint8)
+    canvas[dy:dy + new_h, dx:dx + new_w] = cv2.resize(
+        image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    return canvas
 
-    def __init__(self):
-        self.initialize = True
-        self.net = None
-        self.dest_dir = os.path.expanduser(
-            '~'
-        ) + os.path.sep + '.cvlib' + os.path.sep + 'object_detection' + os.path.sep + 'yolo' + os.path.sep + 'yolov3'
+
+class DetectionModel:
+    """Object detection over the yolo models served by `cvlib`.
+
+    Args:
+        replicas: Number of copies of each network, i.e. how many
+            forward passes of the same model may run concurrently
+        num_threads: OpenCV intra-op thread count (None keeps OpenCV's default).
+            OpenCV applies it process-wide, so it bounds every replica
+        per_class_nms: Run non-maximum suppression separately for each class
+        input_sizes: Network input size per model name, overriding the
+            model's default (one of `INPUT_SIZES`)
+        letterbox: Keep the aspect ratio of the images fed to the network,
+            padding them, instead of stretching them to a square
+        runtime: `opencv`, or `onnxruntime` to run ONNX exports of the models
+            found in `onnx_dir` (see `yoso.model.backends`)
+        dnn_backend, dnn_target: OpenCV DNN backend and target names
+        model_dir: Directory of the model files (None: cvlib's)
+        checksums: Expected SHA-256 per model file name
+        download: Whether missing model files may be downloaded (see
+            `yoso.model.artifacts`)
+
+    The durations of the preprocess, forward and postprocess stages and the
+    waits for a free replica are reported to `observe(stage, model, seconds)`,
+    `yoso.prometheus.observe_stage` by default.
+    """
+
+    def __init__(self,
+                 replicas=1,
+                 num_threads=None,
+                 per_class_nms=False,
+                 input_sizes=None,
+                 letterbox=True,
+                 runtime="opencv",
+                 dnn_backend="default",
+                 dnn_target="cpu",
+                 onnx_dir=None,
+                 model_dir=None,
+                 checksums=None,
+                 download=True):
+        self.dest_dir = model_dir or DEFAULT_DIR
+        self.store = ArtifactStore(self.dest_dir,
+                                   checksums=checksums,
+                                   download=download)
         self.classes = None
-        self.COLORS = np.random.uniform(0, 255, size=(80, 3))
-        self.lock = threading.Lock()
+        # label -> class id
+        self.class_index = None
+        self.renderer = None
+        self.input_sizes = dict(input_sizes or {})
+        self.registry = ModelRegistry(self.store,
+                                      replicas=replicas,
+                                      input_sizes=self.input_sizes,
+                                      runtime=runtime,
+                                      dnn_backend=dnn_backend,
+                                      dnn_target=dnn_target,
+                                      onnx_dir=onnx_dir,
+                                      num_threads=num_threads)
+        self.per_class_nms = per_class_nms
+        for model, size in self.input_sizes.items():
+            assert size in INPUT_SIZES, f"Invalid input size {size} for {model}"
+        self.letterbox = letterbox
+        self.observe = observe_stage
+        # set on the threads running warm-up detections, kept out of `observe`
+        self.warming_up = threading.local()
+        if num_threads is not None:
+            cv2.setNumThreads(num_threads)
+
+    def preload(self, models):
+        """Load class labels and the networks of `models` ahead of time"""
+        self.populate_class_labels()
+        self.registry.preload(models)
+
+    def warmup(self, models, iterations=1):
+        """Run `iterations` detections on a synthetic image through every
+        replica of each of `models`, so that OpenCV's first-forward
+        allocations are not paid by the first requests.
+        Returns:
+            A dict of model name to the list of warm-up durations (seconds)
+        """
+        rng = np.random.default_rng(0)
+        timings = {}
+        self.warming_up.active = True
+        try:
+            self._warmup(models, iterations, rng, timings)
+        finally:
+            self.warming_up.active = False
+        return timings
+
+    def _warmup(self, models, iterations, rng, timings):
+        for model in models:
+            entry = self.registry.get(model)
+            size = self.input_size(model)
+            image = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+            timings[model] = []
+            # replicas are checked out in FIFO order, so consecutive
+            # detections cycle through all of them
+            for _ in range(iterations * len(entry.nets)):
+                tic = time.perf_counter()
+                self.detect_common_objects(image, model=model)
+                elapsed = time.perf_counter() - tic
+                WARMUP_SECONDS.labels(model=model).observe(elapsed)
+                timings[model].append(elapsed)
+
+    def _observe(self, stage, model, seconds):
+        if not getattr(self.warming_up, "active", False):
+            self.observe(stage, model, seconds)
 
     def populate_class_labels(self):
 
-        class_file_name = 'yolov3_classes.txt'
-        class_file_abs_path = self.dest_dir + os.path.sep + class_file_name
-        url = 'https://github.com/arunponnusamy/object-detection-opencv/raw/master/yolov3.txt'
-        if not os.path.exists(class_file_abs_path):
-            download_file(url=url,
-                          file_name=class_file_name,
-                          dest_dir=self.dest_dir)
-        f = open(class_file_abs_path, 'r')
-        self.classes = [line.strip() for line in f.readlines()]
+        class_file_abs_path = self.store.ensure(CLASSES_FILE_NAME, CLASSES_URL)
+        self.store.verify(class_file_abs_path)
+        with open(class_file_abs_path, 'r') as f:
+            self.classes = [line.strip() for line in f.readlines()]
+        self.class_index = {c: i for i, c in enumerate(self.classes)}
+        self.renderer = Renderer(self.classes)
 
         return self.classes
 
-    def get_output_layers(self):
-        layer_names = self.net.getLayerNames()
-        #print(layer_names)
-
-        #print(self.net.getUnconnectedOutLayers())
-        output_layers = [
-            layer_names[i[0] - 1] for i in self.net.getUnconnectedOutLayers()
-        ]
-
-        return output_layers
+    def input_size(self, model, size=None):
+        """Network input size of a request for `model`: `size` if given,
+        else the configured or default size of the model"""
+        if size is not None:
+            assert size in INPUT_SIZES, f"Invalid input size {size}"
+            return size
+        if model in self.input_sizes:
+            return self.input_sizes[model]
+        return MODEL_SPECS.get(model, MODEL_SPECS[DEFAULT_MODEL]).input_size
+
+    def box_transform(self, shape, size):
+        """Map from normalized network coordinates to pixels of an image
+        of `shape` fed at `size`, as (ax, bx, ay, by): x = ax * u + bx"""
+        height, width = shape
+        if not self.letterbox:
+            return width, 0, height, 0
+        r, _, _, dx, dy = letterbox_geometry(shape, size)
+        return size / r, -dx / r, size / r, -dy / r
+
+    def class_ids(self, labels):
+        """Map labels back to their class ids"""
+        if self.class_index is None:
+            self.populate_class_labels()
+        return [self.class_index[label] for label in labels]
 
     def draw_bbox(self,
                   img,
@@ -61,7 +180,8 @@ class DetectionModel:
                   labels,
                   confidence,
                   colors=None,
-                  write_conf=False):
+                  write_conf=False,
+                  max_dim=None):
         """A method to apply a box to the image
         Args:
             img: An image in the form of a numPy array
@@ -69,39 +189,27 @@ class DetectionModel:
             labels: An array of labels
             colors: An array of colours the length of the number of targets(80)
             write_conf: An option to write the confidences to the image
+            max_dim: Draw on a preview downscaled to this long side instead
+        Returns:
+            The annotated image, `img` itself unless downscaled
         """
+        class_ids = self.class_ids(labels)
+        renderer = self.renderer
+        if colors is not None:
+            renderer = Renderer(self.classes, colors=colors)
+        return renderer.draw(img,
+                             bbox,
+                             class_ids,
+                             confidence if write_conf else None,
+                             max_dim=max_dim)
 
-        COLORS = self.COLORS
-        classes = self.classes
-
-        if classes is None:
-            classes = self.populate_class_labels()
-
-        for i, label in enumerate(labels):
-
-            if colors is None:
-                color = COLORS[classes.index(label)]
-            else:
-                color = colors[classes.index(label)]
-
-            if write_conf:
-                label += ' ' + str(format(confidence[i] * 100, '.2f')) + '%'
-
-            cv2.rectangle(img, (bbox[i][0], bbox[i][1]),
-                          (bbox[i][2], bbox[i][3]), color, 2)
-
-            cv2.putText(img, label, (bbox[i][0], bbox[i][1] - 10),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-
-        return img
-
-    @locking
     def detect_common_objects(self,
                               image,
                               confidence=0.5,
                               nms_thresh=0.3,
                               model='yolov4',
-                              enable_gpu=False):
+                              enable_gpu=False,
+                              size=None):
         """A method to detect common objects
         Args:
             image: A colour image in a numpy array
@@ -109,121 +217,146 @@ class DetectionModel:
             nms_thresh: An NMS value
             model: The detection model to be used, supported models are: yolov3, yolov3-tiny, yolov4, yolov4-tiny
             enable_gpu: A boolean to set whether the GPU will be used
+            size: The network input size (None: the model's, see `input_size`)
         """
-
-        Height, Width = image.shape[:2]
+        return self.detect_batch([image], [confidence], [nms_thresh], model,
+                                 enable_gpu, size)[0]
+
+    def detect_batch(self,
+                     images,
+                     confidences,
+                     nms_threshs,
+                     model='yolov4',
+                     enable_gpu=False,
+                     size=None):
+        """Detect common objects on several images with a single forward pass.
+        Args:
+            images: A list of colour images as numpy arrays
+            confidences: The confidence threshold to apply for each image
+            nms_threshs: The NMS threshold to apply for each image
+            model: The detection model to be used (shared by all the images)
+            enable_gpu: A boolean to set whether the GPU will be used
+            size: The network input size (None: the model's, see `input_size`)
+        Returns:
+            A list with one (bbox, label, conf) triple per input image
+        """
+        if self.classes is None:
+            self.populate_class_labels()
+
+        size = self.input_size(model, size)
+        outs = self.forward(images, model, enable_gpu, size)
+
+        results = []
+        for i, image in enumerate(images):
+            tic = time.perf_counter()
+            results.append(
+                self.postprocess(outs[i], image.shape[:2], confidences[i],
+                                 nms_threshs[i],
+                                 self.box_transform(image.shape[:2], size)))
+            self._observe("postprocess", model, time.perf_counter() - tic)
+        return results
+
+    def forward(self, images, model='yolov4', enable_gpu=False, size=None):
+        """Run a single forward pass of `model` over `images`, fed at `size`
+        (letterboxed, or stretched if `letterbox` is off).
+        Returns:
+            A list with, for each input image, the list of its outputs
+            (one (rows, 85) array per output layer)
+        """
+        entry = self.registry.get(model)
+        size = self.input_size(model, size)
+        tic = time.perf_counter()
+        blob = self.blob(images, size)
+        self._observe("preprocess", model, time.perf_counter() - tic)
+
+        tic = time.perf_counter()
+        with entry.checkout() as net:
+            self._observe("lock_wait", model, time.perf_counter() - tic)
+            tic = time.perf_counter()
+            # enables opencv dnn module to use CUDA on Nvidia card instead of cpu
+            if enable_gpu:
+                net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+                net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+
+            net.setInput(blob)
+
+            outs = net.forward(entry.output_layers)
+            self._observe("forward", model, time.perf_counter() - tic)
+
+        # the region layers produce a (rows, 85) matrix for a single image
+        # and a (batch, rows, 85) tensor otherwise: split them per image.
+        n = len(images)
+        outs = [out.reshape(n, -1, out.shape[-1]) for out in outs]
+
+        return [[out[i] for out in outs] for i in range(n)]
+
+    def blob(self, images, size):
+        """NCHW network input of `images` fed at `size`, letterboxed or
+        stretched"""
         scale = 0.00392
+        if self.letterbox:
+            images = [letterbox(image, size) for image in images]
+        return cv2.dnn.blobFromImages(images,
+                                      scale, (size, size), (0, 0, 0),
+                                      True,
+                                      crop=False)
+
+    def postprocess(self, outs, shape, confidence, nms_thresh,
+                    transform=None):
+        """Turn the raw outputs of a single image into (bbox, label, conf).
+
+        Candidates are decoded in a single NumPy pass over the concatenated
+        outputs, then filtered by one `cv2.dnn.NMSBoxes` call. With
+        `per_class_nms` boxes of different classes never suppress each other.
+        Boxes are mapped to pixels by `transform` (see `box_transform`),
+        stretching the network input over `shape` by default.
+        """
 
+        Height, Width = shape
         classes = self.classes
-        dest_dir = self.dest_dir
-
-        if model == 'yolov3-tiny':
-            config_file_name = 'yolov3-tiny.cfg'
-            cfg_url = "https://github.com/pjreddie/darknet/raw/master/cfg/yolov3-tiny.cfg"
-            weights_file_name = 'yolov3-tiny.weights'
-            weights_url = 'https://pjreddie.com/media/files/yolov3-tiny.weights'
-            blob = cv2.dnn.blobFromImage(image,
-                                         scale, (416, 416), (0, 0, 0),
-                                         True,
-                                         crop=False)
-
-        elif model == 'yolov4':
-            config_file_name = 'yolov4.cfg'
-            cfg_url = 'https://raw.githubusercontent.com/AlexeyAB/darknet/master/cfg/yolov4.cfg'
-            weights_file_name = 'yolov4.weights'
-            weights_url = 'https://github.com/AlexeyAB/darknet/releases/download/darknet_yolo_v3_optimal/yolov4.weights'
-            blob = cv2.dnn.blobFromImage(image,
-                                         scale, (416, 416), (0, 0, 0),
-                                         True,
-                                         crop=False)
-
-        elif model == 'yolov4-tiny':
-            config_file_name = 'yolov4-tiny.cfg'
-            cfg_url = 'https://raw.githubusercontent.com/AlexeyAB/darknet/master/cfg/yolov4-tiny.cfg'
-            weights_file_name = 'yolov4-tiny.weights'
-            weights_url = 'https://github.com/AlexeyAB/darknet/releases/download/darknet_yolo_v4_pre/yolov4-tiny.weights'
-            blob = cv2.dnn.blobFromImage(image,
-                                         scale, (416, 416), (0, 0, 0),
-                                         True,
-                                         crop=False)
-
-        else:
-            config_file_name = 'yolov3.cfg'
-            cfg_url = 'https://github.com/arunponnusamy/object-detection-opencv/raw/master/yolov3.cfg'
-            weights_file_name = 'yolov3.weights'
-            weights_url = 'https://pjreddie.com/media/files/yolov3.weights'
-            blob = cv2.dnn.blobFromImage(image,
-                                         scale, (416, 416), (0, 0, 0),
-                                         True,
-                                         crop=False)
-
-        config_file_abs_path = dest_dir + os.path.sep + config_file_name
-        weights_file_abs_path = dest_dir + os.path.sep + weights_file_name
-
-        if not os.path.exists(config_file_abs_path):
-            download_file(url=cfg_url,
-                          file_name=config_file_name,
-                          dest_dir=dest_dir)
-
-        if not os.path.exists(weights_file_abs_path):
-            download_file(url=weights_url,
-                          file_name=weights_file_name,
-                          dest_dir=dest_dir)
-
-        if self.initialize:
-            classes = self.populate_class_labels()
-            self.net = cv2.dnn.readNet(weights_file_abs_path,
-                                       config_file_abs_path)
-            self.initialize = False
-
-        # enables opencv dnn module to use CUDA on Nvidia card instead of cpu
-        if enable_gpu:
-            self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-            self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
-
-        self.net.setInput(blob)
-
-        outs = self.net.forward(self.get_output_layers())
-
-        class_ids = []
-        confidences = []
-        boxes = []
-
-        for out in outs:
-            for detection in out:
-                try:
-                    scores = detection[5:]
-                    class_id = np.argmax(scores)
-                    max_conf = scores[class_id]
-                    if max_conf > confidence:
-                        center_x = int(detection[0] * Width)
-                        center_y = int(detection[1] * Height)
-                        w = int(detection[2] * Width)
-                        h = int(detection[3] * Height)
-                        x = center_x - (w / 2)
-                        y = center_y - (h / 2)
-                        class_ids.append(class_id)
-                        confidences.append(float(max_conf))
-                        boxes.append([x, y, w, h])
-                except Exception as e:
-                    print("---->", outs)
-                    raise (e)
-
-        indices = cv2.dnn.NMSBoxes(boxes, confidences, confidence, nms_thresh)
-
-        bbox = []
-        label = []
-        conf = []
-
-        for idx in indices:
-            i = idx[0]
-            box = boxes[i]
-            x = box[0]
-            y = box[1]
-            w = box[2]
-            h = box[3]
-            bbox.append([int(x), int(y), int(x + w), int(y + h)])
-            label.append(str(classes[class_ids[i]]))
-            conf.append(confidences[i])
+
+        detections = np.concatenate(outs, axis=0)
+        scores = detections[:, 5:]
+        class_ids = scores.argmax(axis=1)
+        max_conf = scores[np.arange(len(scores)), class_ids]
+
+        keep = max_conf > confidence
+        if not keep.any():
+            return [], [], []
+        detections = detections[keep]
+        class_ids = class_ids[keep]
+        max_conf = max_conf[keep]
+
+        ax, bx, ay, by = transform or (Width, 0, Height, 0)
+        # center/size to top left corner, truncated as int() would
+        center_x = np.trunc(detections[:, 0] * ax + bx)
+        center_y = np.trunc(detections[:, 1] * ay + by)
+        w = np.trunc(detections[:, 2] * ax)
+        h = np.trunc(detections[:, 3] * ay)
+        x = center_x - w / 2
+        y = center_y - h / 2
+        boxes = np.stack([x, y, w, h], axis=1)
+
+        nms_boxes = boxes
+        if self.per_class_nms:
+            # shift each class to its own region so classes cannot overlap:
+            # by the extent of the boxes, which can reach past the image
+            lo = min(x.min(), y.min())
+            hi = max((x + w).max(), (y + h).max())
+            shift = class_ids * (hi - lo + 1)
+            nms_boxes = boxes.copy()
+            nms_boxes[:, 0] += shift
+            nms_boxes[:, 1] += shift
+
+        indices = cv2.dnn.NMSBoxes(nms_boxes.tolist(), max_conf.tolist(),
+                                   confidence, nms_thresh)
+        # Nx1 or flat depending on the opencv version
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+
+        x, y, w, h = boxes[indices].T
+        bbox = np.trunc(np.stack([x, y, x + w, y + h], axis=1)).astype(int)
+        bbox = bbox.tolist()
+        label = [str(classes[i]) for i in class_ids[indices]]
+        conf = max_conf[indices].astype(float).tolist()
 
         return bbox, label, conf
@@ -0,0 +1,270 @@
+"""
+Registry of the loaded detection networks, keyed by model name.
+
+Each entry owns a pool of `cv2.dnn.Net` replicas, the names of its output
+layers (looked up once at load time) and its network input size, so that
+requests for different models never share, or wait on, the same net, and
+requests for the same model can run on up to `replicas` nets at once.
+Nets are run by OpenCV or onnxruntime, see `yoso.model.backends`.
+"""
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from yoso.model.artifacts import ArtifactStore
+from yoso.model.backends import RUNTIMES, OnnxNet, dnn_preference, dnn_ids
+from yoso.prometheus import MODEL_LOAD_SECONDS, MODEL_MEMORY_BYTES
+
+
+class ModelSpec:
+    "Where to find the darknet cfg/weights pair of a model"
+
+    def __init__(self,
+                 config_file_name,
+                 cfg_url,
+                 weights_file_name,
+                 weights_url,
+                 input_size=416):
+        self.config_file_name = config_file_name
+        self.cfg_url = cfg_url
+        self.weights_file_name = weights_file_name
+        self.weights_url = weights_url
+        self.input_size = input_size
+
+
+# class labels shared by every model
+CLASSES_FILE_NAME = "yolov3_classes.txt"
+CLASSES_URL = "https://github.com/arunponnusamy/object-detection-opencv/raw/master/yolov3.txt"
+
+# network input sizes accepted per model or per request (multiples of 32)
+INPUT_SIZES = (320, 416, 608)
+
+MODEL_SPECS = {
+    "yolov3-tiny":
+    ModelSpec(
+        'yolov3-tiny.cfg',
+        "https://github.com/pjreddie/darknet/raw/master/cfg/yolov3-tiny.cfg",
+        'yolov3-tiny.weights',
+        'https://pjreddie.com/media/files/yolov3-tiny.weights'),
+    "yolov3":
+    ModelSpec(
+        'yolov3.cfg',
+        'https://github.com/arunponnusamy/object-detection-opencv/raw/master/yolov3.cfg',
+        'yolov3.weights', 'https://pjreddie.com/media/files/yolov3.weights'),
+    "yolov4":
+    ModelSpec(
+        'yolov4.cfg',
+        'https://raw.githubusercontent.com/AlexeyAB/darknet/master/cfg/yolov4.cfg',
+        'yolov4.weights',
+        'https://github.com/AlexeyAB/darknet/releases/download/darknet_yolo_v3_optimal/yolov4.weights'
+    ),
+    "yolov4-tiny":
+    ModelSpec(
+        'yolov4-tiny.cfg',
+        'https://raw.githubusercontent.com/AlexeyAB/darknet/master/cfg/yolov4-tiny.cfg',
+        'yolov4-tiny.weights',
+        'https://github.com/AlexeyAB/darknet/releases/download/darknet_yolo_v4_pre/yolov4-tiny.weights'
+    ),
+}
+
+
+# unknown model names fall back to this one, as in `cvlib`
+DEFAULT_MODEL = "yolov3"
+
+
+def _rss_bytes():
+    "Resident set size of this process (0 when it cannot be determined)"
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class ModelEntry:
+    """A pool of loaded network replicas together with their cached metadata.
+
+    A `cv2.dnn.Net` cannot run concurrent forwards, so each replica is
+    checked out by a single caller at a time via `checkout`.
+    """
+
+    def __init__(self,
+                 name,
+                 nets,
+                 output_layers,
+                 input_size,
+                 load_seconds,
+                 memory_bytes,
+                 weights_bytes,
+                 backend="opencv"):
+        self.name = name
+        # runtime (and OpenCV backend/target) running the nets
+        self.backend = backend
+        self.nets = nets
+        self.output_layers = output_layers
+        self.input_size = input_size
+        self.load_seconds = load_seconds
+        self.memory_bytes = memory_bytes
+        self.weights_bytes = weights_bytes
+        self.pool = queue.Queue()
+        for net in nets:
+            self.pool.put(net)
+
+    @contextmanager
+    def checkout(self):
+        "Borrow a replica, blocking until one is free"
+        net = self.pool.get()
+        try:
+            yield net
+        finally:
+            self.pool.put(net)
+
+    def stats(self):
+        "Summary of the entry, as reported by `/models`"
+        return {
+            "replicas": len(self.nets),
+            "backend": self.backend,
+            "input_size": self.input_size,
+            "output_layers": self.output_layers,
+            "load_seconds": self.load_seconds,
+            "memory_bytes": self.memory_bytes,
+            "weights_bytes": self.weights_bytes,
+        }
+
+
+class ModelRegistry:
+    """Load and hold one `ModelEntry` per model name.
+
+    Models are loaded on first use, or ahead of time via `preload`, with
+    `replicas` copies of each network, from the files of `store`.
+    `input_sizes` overrides the default input size of the named models.
+
+    With the `opencv` runtime nets run on `dnn_backend`/`dnn_target`; with
+    `onnxruntime`, the `<model>.onnx` exports found in `onnx_dir` are run
+    with `num_threads` intra-op threads (see `yoso.model.backends`).
+    """
+
+    def __init__(self,
+                 store: ArtifactStore,
+                 replicas=1,
+                 input_sizes=None,
+                 runtime="opencv",
+                 dnn_backend="default",
+                 dnn_target="cpu",
+                 onnx_dir=None,
+                 num_threads=None):
+        assert replicas >= 1, "replicas must be at least 1"
+        assert runtime in RUNTIMES, f"Invalid runtime {runtime}"
+        self.store = store
+        self.replicas = replicas
+        self.input_sizes = dict(input_sizes or {})
+        self.runtime = runtime
+        self.dnn_backend = dnn_backend
+        self.dnn_target = dnn_target
+        self.onnx_dir = onnx_dir or store.directory
+        self.num_threads = num_threads
+        # supported (backend, target) names, resolved on the first load
+        self.preference = None
+        self.entries = {}
+        # serializes loading, so a model is never read twice
+        self.lock = threading.Lock()
+
+    def model_files(self, name):
+        """Resolve (downloading if missing and allowed) the cfg and weights
+        paths of `name`"""
+        spec = MODEL_SPECS[name]
+        return (self.store.ensure(spec.config_file_name, spec.cfg_url),
+                self.store.ensure(spec.weights_file_name, spec.weights_url))
+
+    def onnx_file(self, name):
+        "Path of the ONNX export of `name`, which must already exist"
+        path = os.path.join(self.onnx_dir, f"{name}.onnx")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No ONNX export of {name} at {path}")
+        self.store.verify(path)
+        return path
+
+    def _read_nets(self, config_file_abs_path, weights_file_abs_path):
+        """Read `replicas` nets, returning them with their output layer names
+        and a description of the backend running them"""
+        if self.runtime == "onnxruntime":
+            nets = [
+                OnnxNet(weights_file_abs_path, self.num_threads)
+                for _ in range(self.replicas)
+            ]
+            return nets, nets[0].getUnconnectedOutLayersNames(), "onnxruntime"
+
+        if self.preference is None:
+            self.preference = dnn_preference(self.dnn_backend,
+                                             self.dnn_target)
+        # verified once, then read from their path: every replica parses
+        # the weights into its own blobs (about the size of the file each)
+        self.store.verify(config_file_abs_path)
+        self.store.verify(weights_file_abs_path)
+        nets = [
+            cv2.dnn.readNetFromDarknet(config_file_abs_path,
+                                       weights_file_abs_path)
+            for _ in range(self.replicas)
+        ]
+        backend_id, target_id = dnn_ids(*self.preference)
+        for net in nets:
+            net.setPreferableBackend(backend_id)
+            net.setPreferableTarget(target_id)
+        layer_names = nets[0].getLayerNames()
+        # flattened, as the shape of this array changed across opencv versions
+        output_layers = [
+            layer_names[i - 1]
+            for i in np.asarray(nets[0].getUnconnectedOutLayers()).flatten()
+        ]
+        return nets, output_layers, "opencv {}/{}".format(*self.preference)
+
+    def _load(self, name):
+        spec = MODEL_SPECS[name]
+        if self.runtime == "onnxruntime":
+            config_path, weights_path = None, self.onnx_file(name)
+        else:
+            config_path, weights_path = self.model_files(name)
+
+        rss_before = _rss_bytes()
+        tic = time.perf_counter()
+        nets, output_layers, backend = self._read_nets(config_path,
+                                                       weights_path)
+        load_seconds = time.perf_counter() - tic
+        memory_bytes = max(_rss_bytes() - rss_before, 0)
+
+        MODEL_LOAD_SECONDS.labels(model=name).set(load_seconds)
+        MODEL_MEMORY_BYTES.labels(model=name).set(memory_bytes)
+
+        return ModelEntry(name, nets, output_layers,
+                          self.input_sizes.get(name, spec.input_size),
+                          load_seconds,
+                          memory_bytes,
+                          os.path.getsize(weights_path),
+                          backend=backend)
+
+    def get(self, name) -> ModelEntry:
+        "Return the entry of model `name`, loading it if needed"
+        if name not in MODEL_SPECS:
+            name = DEFAULT_MODEL
+        entry = self.entries.get(name)
+        if entry is None:
+            with self.lock:
+                entry = self.entries.get(name)
+                if entry is None:
+                    entry = self._load(name)
+                    self.entries[name] = entry
+        return entry
+
+    def preload(self, names):
+        "Load all the models in `names` ahead of the first request"
+        for name in names:
+            self.get(name)
+
+    def stats(self):
+        "Per-model load time and memory of the loaded entries"
+        return {name: entry.stats() for name, entry in self.entries.items()}
@@ -0,0 +1,342 @@
+"""
+Multi-process inference workers.
+
+Each worker process holds its own `DetectionModel`, so decoding of the
+network outputs does not contend on the GIL of the serving process.
+Decoded frames are handed over through `multiprocessing.shared_memory`
+instead of being pickled, and only the compact (bbox, label, conf)
+detections travel back.
+
+Every worker has its own task queue and result pipe, and the serving
+process assigns each task to a worker: it always knows which tasks a worker
+holds, and a worker killed at any point (e.g. while holding the lock of a
+queue it reads) cannot stall the others.
+"""
+import itertools
+import multiprocessing as mp
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from yoso.console import console
+from yoso.executor import Overloaded
+from yoso.prometheus import (REQUESTS_REJECTED, WARMUP_SECONDS, WORKER_UP,
+                             WORKER_QUEUE_DEPTH, observe_stage)
+
+# messages sent by the workers on their result pipe
+READY, DONE, ERROR = "ready", "done", "error"
+
+
+def _worker_main(worker_id, tasks, results, models, model_options,
+                 warmup_iterations):
+    """Entry point of a worker process: serve the tasks of its `tasks` queue
+    until a `None` arrives, sending the outcomes on the `results` pipe"""
+    # imported here so the serving process never loads a network itself
+    from yoso.model.my_model import DetectionModel
+
+    od_model = DetectionModel(**model_options)
+    od_model.preload(models)
+    # metrics of this process are not exported: send the timings back
+    timings = od_model.warmup(models, warmup_iterations)
+    results.send((READY, worker_id, (timings, od_model.registry.stats())))
+    # (stage, model, seconds) of the task being run, sent with its result
+    stages = []
+    od_model.observe = lambda *stage: stages.append(stage)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        (task_id, shm_name, shape, model, confidence, nms_thresh, size,
+         queued) = task
+        stages.clear()
+        # CLOCK_MONOTONIC is shared by the processes of a host
+        stages.append(("queue_wait", model, time.monotonic() - queued))
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name)
+        except FileNotFoundError:
+            # the task timed out, or was cancelled, while queued
+            results.send((ERROR, task_id, "cancelled"))
+            continue
+        try:
+            image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            result = od_model.detect_common_objects(image,
+                                                    confidence=confidence,
+                                                    nms_thresh=nms_thresh,
+                                                    model=model,
+                                                    size=size)
+            # the view must be released before the segment can be closed
+            del image
+            results.send((DONE, task_id, (result, list(stages))))
+        except Exception as e:
+            results.send((ERROR, task_id, repr(e)))
+        finally:
+            shm.close()
+
+
+class WorkerPool:
+    """Run detections on a pool of worker processes.
+
+    Exposes the same `detect_common_objects` signature as `DetectionModel`
+    so it can be used as a drop-in replacement by the request handlers.
+    Tasks go to the ready worker holding the fewest. Workers are started by
+    `start` and replaced if they die, the tasks they held failing with a
+    `RuntimeError`; tasks pending for more than `task_timeout` seconds
+    (None: no limit), e.g. on a hung worker, fail with a `TimeoutError`.
+    Once `stop` is called, new tasks are rejected with `Overloaded`.
+    Each worker builds its `DetectionModel` from the `model_options` keyword
+    arguments, and reports the load stats of its models (see `stats`) once
+    ready.
+    """
+
+    def __init__(self,
+                 n_workers: int = 2,
+                 models=("yolov3-tiny", "yolov3"),
+                 model_options=None,
+                 warmup_iterations=1,
+                 task_timeout=None):
+        assert n_workers >= 1, "n_workers must be at least 1"
+        self.n_workers = n_workers
+        self.models = list(models)
+        self.model_options = dict(model_options or {})
+        self.warmup_iterations = warmup_iterations
+        self.task_timeout = task_timeout
+        # spawn, so workers do not inherit the threads of the server
+        self.ctx = mp.get_context("spawn")
+        # worker id -> process, task queue, and receiving end of its result
+        # pipe (created by `_spawn`, as spawned workers re-import the server
+        # module)
+        self.processes = {}
+        self.queues = {}
+        self.conns = {}
+        self.ready = set()
+        # worker id -> load stats of its models, as sent with READY
+        self.worker_stats = {}
+        # worker id -> ids of the tasks assigned to it and not done yet
+        self.assigned = {}
+        # task id -> (Future of its result, deadline or None, worker id)
+        self.pending = {}
+        self.task_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.dispatcher = None
+        WORKER_QUEUE_DEPTH.set_function(lambda: len(self.pending))
+
+    def _spawn(self, worker_id):
+        """Start a worker process as `worker_id`, taking over the entries of
+        the one it replaces, if any: returns that one's task queue and the
+        ids of the tasks it held"""
+        tasks = self.ctx.Queue()
+        receiver, sender = self.ctx.Pipe(duplex=False)
+        p = self.ctx.Process(target=_worker_main,
+                             args=(worker_id, tasks, sender, self.models,
+                                   self.model_options,
+                                   self.warmup_iterations),
+                             name=f"yoso-inference-worker-{worker_id}",
+                             daemon=True)
+        p.start()
+        # only the worker holds the sending end: reads fail once it died
+        sender.close()
+        with self.lock:
+            # swapped at once, so `submit` always finds a queue to use
+            self.processes[worker_id] = p
+            replaced = self.queues.get(worker_id)
+            self.queues[worker_id] = tasks
+            lost = self.assigned.get(worker_id, set())
+            self.assigned[worker_id] = set()
+            if self.stopped:
+                # `stop` did not see this queue
+                tasks.put(None)
+        self.conns[worker_id] = receiver
+        WORKER_UP.labels(worker=str(worker_id)).set_function(
+            lambda: float(worker_id in self.ready and p.is_alive()))
+        return replaced, lost
+
+    def start(self):
+        "Spawn the worker processes and the result dispatcher"
+        console.log(f"Starting {self.n_workers} inference worker processes")
+        for worker_id in range(self.n_workers):
+            self._spawn(worker_id)
+        self.dispatcher = threading.Thread(target=self._dispatch,
+                                           name="yoso-worker-dispatcher",
+                                           daemon=True)
+        self.dispatcher.start()
+
+    def stop(self):
+        """Ask the workers to exit once the queued tasks are served, failing
+        the tasks of those that do not in time"""
+        with self.lock:
+            self.stopped = True
+            for tasks in self.queues.values():
+                tasks.put(None)
+        for p in list(self.processes.values()):
+            p.join(timeout=5)
+        if self.dispatcher is not None:
+            self.dispatcher.join(timeout=5)
+        with self.lock:
+            left = list(self.pending)
+        for task_id in left:
+            self._resolve(task_id,
+                          error=RuntimeError("Inference worker pool stopped"))
+
+    def _resolve(self, task_id, result=None, error=None):
+        with self.lock:
+            future, _, worker_id = self.pending.pop(task_id,
+                                                    (None, None, None))
+            if worker_id is not None:
+                self.assigned[worker_id].discard(task_id)
+        # cancelled futures (e.g. by a request timeout) are already done
+        if future is None or not future.set_running_or_notify_cancel():
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def _expire(self):
+        "Fail the tasks pending for longer than `task_timeout`"
+        now = time.monotonic()
+        with self.lock:
+            expired = [
+                task_id for task_id, (_, deadline, _) in self.pending.items()
+                if deadline is not None and deadline < now
+            ]
+        for task_id in expired:
+            self._resolve(task_id,
+                          error=TimeoutError(
+                              f"Detection not done after {self.task_timeout}s"))
+
+    def _replace(self, worker_id):
+        """Replace a dead worker, failing the tasks it held. Called once
+        everything it sent before dying has been handled."""
+        if not self.stopped:
+            console.log(f"[red]Inference worker {worker_id} died[/]")
+        self.ready.discard(worker_id)
+        self.worker_stats.pop(worker_id, None)
+        self.conns.pop(worker_id).close()
+        with self.lock:
+            stopped = self.stopped
+            if stopped:
+                tasks = self.queues.pop(worker_id)
+                lost = self.assigned[worker_id]
+                self.assigned[worker_id] = set()
+        if not stopped:
+            tasks, lost = self._spawn(worker_id)
+        # nobody reads it anymore: drop what is still buffered
+        tasks.cancel_join_thread()
+        tasks.close()
+        for task_id in lost:
+            self._resolve(task_id,
+                          error=RuntimeError(
+                              f"Inference worker {worker_id} died"))
+
+    def _handle(self, kind, key, payload):
+        if kind == READY:
+            timings, stats = payload
+            for model, elapsed in timings.items():
+                for seconds in elapsed:
+                    WARMUP_SECONDS.labels(model=model).observe(seconds)
+            self.worker_stats[key] = stats
+            self.ready.add(key)
+        elif kind == DONE:
+            result, stages = payload
+            for stage in stages:
+                observe_stage(*stage)
+            self._resolve(key, result=result)
+        elif kind == ERROR:
+            self._resolve(key, error=RuntimeError(payload))
+
+    def _dispatch(self):
+        # until every worker exited, once stopped
+        while self.conns:
+            workers = {conn: worker_id
+                       for worker_id, conn in self.conns.items()}
+            for conn in wait(list(workers), timeout=1):
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    # pipes are read in order: the worker died after
+                    # everything it sent was handled
+                    self._replace(workers[conn])
+                else:
+                    self._handle(*message)
+            self._expire()
+
+    def stats(self):
+        """Per-model load stats over the ready workers, as reported by
+        `/models`: replicas and memory add up, the load time is the slowest
+        worker's"""
+        models = {}
+        for stats in list(self.worker_stats.values()):
+            for name, entry in stats.items():
+                total = models.get(name)
+                if total is None:
+                    models[name] = dict(entry)
+                    continue
+                total["replicas"] += entry["replicas"]
+                total["memory_bytes"] += entry["memory_bytes"]
+                total["load_seconds"] = max(total["load_seconds"],
+                                            entry["load_seconds"])
+        return models
+
+    def is_ready(self):
+        "Whether every worker has loaded and warmed up its models"
+        return len(self.ready) == self.n_workers
+
+    def submit(self,
+               image,
+               confidence=0.5,
+               nms_thresh=0.3,
+               model='yolov4',
+               size=None):
+        "Enqueue a detection request, returns a `Future` of (bbox, label, conf)"
+        if image is None:
+            raise ValueError("Cannot run detection on an empty image")
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+
+        def release(_):
+            shm.close()
+            shm.unlink()
+
+        task_id = next(self.task_ids)
+        future = Future()
+        deadline = (None if self.task_timeout is None else time.monotonic() +
+                    self.task_timeout)
+        try:
+            np.ndarray(image.shape, dtype=np.uint8, buffer=shm.buf)[:] = image
+            with self.lock:
+                if self.stopped:
+                    REQUESTS_REJECTED.labels(reason="overloaded").inc()
+                    raise Overloaded()
+                # ready workers first, then the one holding the fewest tasks
+                worker_id = min(self.queues,
+                                key=lambda w:
+                                (w not in self.ready, len(self.assigned[w])))
+                # under the lock, so the queue cannot be closed by `_replace`
+                self.queues[worker_id].put(
+                    (task_id, shm.name, image.shape, getattr(model, "value",
+                                                             model),
+                     confidence, nms_thresh, size, time.monotonic()))
+                self.assigned[worker_id].add(task_id)
+                self.pending[task_id] = (future, deadline, worker_id)
+        except BaseException:
+            release(None)
+            raise
+        # once resolved, failed or cancelled
+        future.add_done_callback(release)
+        return future
+
+    def detect_common_objects(self,
+                              image,
+                              confidence=0.5,
+                              nms_thresh=0.3,
+                              model='yolov4',
+                              size=None):
+        "Blocking detection, see `DetectionModel.detect_common_objects`"
+        return self.submit(image, confidence, nms_thresh, model,
+                           size).result()
@@ -0,0 +1,149 @@
+"""
+Temporal skip and region of interest detection for video frames.
+
+A `FrameDiffer` compares each frame of a stream, downsampled to a small
+grayscale thumbnail, with the frame detections were last computed on:
+- nothing changed: the last detections are reused, no inference runs
+- only a region changed: optionally, detection runs on that crop only and
+  the result is merged with the last detections outside of it
+- otherwise the whole frame is run through detection
+
+Comparing with the last detected frame, rather than the previous one, makes
+slow changes accumulate until they are noticed instead of being skipped
+forever; a full detection is also forced after `max_skip` frames without
+one, which drops the stale boxes region merges may have kept.
+"""
+import threading
+from collections import Counter
+
+import cv2
+import numpy as np
+
+from yoso.prometheus import MOTION_FRAMES, MOTION_SKIP_RATIO
+
+# decisions taken by every differ, backing the skip ratio gauge
+_decisions = Counter()
+_decisions_lock = threading.Lock()
+
+
+def _skip_ratio():
+    with _decisions_lock:
+        total = sum(_decisions.values())
+        return _decisions["skip"] / total if total else 0.0
+
+
+MOTION_SKIP_RATIO.set_function(_skip_ratio)
+
+
+def _overlaps(box, roi):
+    x1, y1, x2, y2 = box
+    rx1, ry1, rx2, ry2 = roi
+    return x1 < rx2 and rx1 < x2 and y1 < ry2 and ry1 < y2
+
+
+class FrameDiffer:
+    """Decide, frame by frame, whether a stream needs detection.
+
+    `decide` must see the frames in order, as must `resolve` their results.
+    A pixel of the `width` wide thumbnail counts as changed when its gray
+    level moved by more than `threshold`; the frame changed when more than
+    `min_changed` of its pixels did.
+    """
+
+    def __init__(self,
+                 threshold: int = 12,
+                 min_changed: float = 0.002,
+                 width: int = 160,
+                 roi: bool = False,
+                 roi_max_area: float = 0.5,
+                 roi_margin: float = 0.1,
+                 max_skip: int = 30):
+        self.threshold = threshold
+        self.min_changed = min_changed
+        self.width = width
+        self.roi = roi
+        self.roi_max_area = roi_max_area
+        self.roi_margin = roi_margin
+        self.max_skip = max_skip
+        # thumbnail of the frame detections were last computed on
+        self.reference = None
+        # frames since the last full detection
+        self.since_full = 0
+        self.last = ([], [], [])
+
+    def thumbnail(self, image):
+        height, width = image.shape[:2]
+        size = (self.width, max(1, round(height * self.width / width)))
+        small = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    def decide(self, image):
+        """Decide how to process `image`: returns the decision (`skip`, `roi`
+        or `full`) and, for `roi`, the [x1, y1, x2, y2] region to detect on"""
+        small = self.thumbnail(image)
+        decision, roi = "full", None
+        if (self.reference is not None
+                and self.reference.shape == small.shape
+                and self.since_full < self.max_skip):
+            changed = cv2.absdiff(small, self.reference) > self.threshold
+            if changed.mean() <= self.min_changed:
+                decision = "skip"
+            elif self.roi:
+                roi = self.changed_region(changed, image.shape)
+                if roi is not None:
+                    decision = "roi"
+
+        self.since_full = 0 if decision == "full" else self.since_full + 1
+        if decision != "skip":
+            self.reference = small
+        MOTION_FRAMES.labels(decision=decision).inc()
+        with _decisions_lock:
+            _decisions[decision] += 1
+        return decision, roi
+
+    def changed_region(self, changed, shape):
+        """Region of the full resolution frame enclosing the `changed` pixels
+        plus a margin, or None if it is larger than `roi_max_area`"""
+        height, width = shape[:2]
+        ys, xs = np.nonzero(changed)
+        scale = width / changed.shape[1]
+        x1, x2 = xs.min() * scale, (xs.max() + 1) * scale
+        y1, y2 = ys.min() * scale, (ys.max() + 1) * scale
+        mx, my = (x2 - x1) * self.roi_margin, (y2 - y1) * self.roi_margin
+        roi = [
+            max(0, int(x1 - mx)),
+            max(0, int(y1 - my)),
+            min(width, int(np.ceil(x2 + mx))),
+            min(height, int(np.ceil(y2 + my)))
+        ]
+        area = (roi[2] - roi[0]) * (roi[3] - roi[1])
+        if area > self.roi_max_area * width * height:
+            return None
+        return roi
+
+    @staticmethod
+    def crop(image, roi):
+        x1, y1, x2, y2 = roi
+        return image[y1:y2, x1:x2]
+
+    def resolve(self, decision, roi, detections=None):
+        """Final (bbox, label, conf) detections of a frame, given those of
+        the detection run for it (None when skipped)"""
+        if decision == "roi":
+            x0, y0 = roi[:2]
+            bbox, label, conf = detections
+            kept = [
+                i for i, box in enumerate(self.last[0])
+                if not _overlaps(box, roi)
+            ]
+            detections = (
+                [self.last[0][i] for i in kept] +
+                [[x1 + x0, y1 + y0, x2 + x0, y2 + y0]
+                 for x1, y1, x2, y2 in bbox],
+                [self.last[1][i] for i in kept] + list(label),
+                [self.last[2][i] for i in kept] + list(conf),
+            )
+        elif decision == "skip":
+            detections = self.last
+        self.last = detections
+        return detections
@@ -1,6 +1,135 @@
+from contextlib import contextmanager
+from time import perf_counter
+
+from prometheus_client import Counter, Gauge, Histogram, Info
 from starlette_prometheus import metrics, PrometheusMiddleware
 from fastapi import FastAPI
 
+# Domain metrics, registered on the default registry exported by `/metrics`
+
+BATCH_SIZE = Histogram("yoso_batch_size",
+                       "Number of images run through a single forward pass",
+                       ["model"],
+                       buckets=(1, 2, 4, 8, 16, 32, 64))
+
+MODEL_LOAD_SECONDS = Gauge("yoso_model_load_seconds",
+                           "Time taken to read a model's network", ["model"])
+
+MODEL_MEMORY_BYTES = Gauge(
+    "yoso_model_memory_bytes",
+    "Resident memory added by loading a model's network", ["model"])
+
+WARMUP_SECONDS = Histogram("yoso_warmup_seconds",
+                           "Duration of the warm-up detections run at startup",
+                           ["model"])
+
+WORKER_UP = Gauge("yoso_worker_up",
+                  "Whether an inference worker process is alive and ready",
+                  ["worker"])
+
+WORKER_QUEUE_DEPTH = Gauge(
+    "yoso_worker_queue_depth",
+    "Requests queued or running on the inference worker processes")
+
+REQUESTS_REJECTED = Counter("yoso_requests_rejected",
+                            "Requests rejected before running inference",
+                            ["reason"])
+
+CACHE_HITS = Counter("yoso_cache_hits",
+                     "Requests answered from the detection cache", ["model"])
+
+CACHE_MISSES = Counter("yoso_cache_misses",
+                       "Requests not found in the detection cache", ["model"])
+
+CACHE_EVICTIONS = Counter("yoso_cache_evictions",
+                          "Entries evicted from the detection cache",
+                          ["reason"])
+
+CACHE_ENTRIES = Gauge("yoso_cache_entries",
+                      "Entries held by the detection cache")
+
+CACHE_INFO = Info("yoso_cache", "Configuration of the detection cache")
+
+STREAM_CONNECTIONS = Gauge("yoso_stream_connections",
+                           "Open /stream WebSocket connections")
+
+STREAM_FRAMES = Counter("yoso_stream_frames",
+                        "Frames received on /stream, processed or dropped",
+                        ["outcome"])
+
+VIDEO_FRAMES = Counter("yoso_video_frames",
+                       "Sampled video frames run through detection by jobs",
+                       ["model"])
+
+MOTION_FRAMES = Counter("yoso_motion_frames",
+                        "Stream and video frames by frame differencing decision",
+                        ["decision"])
+
+MOTION_SKIP_RATIO = Gauge(
+    "yoso_motion_skip_ratio",
+    "Fraction of the frame differenced frames reusing the last detections")
+
+# buckets of the latencies recorded in the request path, see `observe_stage`
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+
+STAGE_SECONDS = Histogram(
+    "yoso_stage_seconds",
+    "Duration of the stages of the inference pipeline (decode, preprocess, "
+    "forward, postprocess, draw, encode)", ["stage", "model"],
+    buckets=LATENCY_BUCKETS)
+
+QUEUE_WAIT_SECONDS = Histogram(
+    "yoso_queue_wait_seconds",
+    "Time detection requests wait in the batching or worker queue",
+    ["model"],
+    buckets=LATENCY_BUCKETS)
+
+LOCK_WAIT_SECONDS = Histogram(
+    "yoso_lock_wait_seconds",
+    "Time forward passes wait for a free network replica", ["model"],
+    buckets=LATENCY_BUCKETS)
+
+DETECTIONS = Counter("yoso_detections", "Objects detected, by class",
+                     ["model", "label"])
+
+EMPTY_PREDICTIONS = Counter("yoso_empty_predictions",
+                            "Predictions without any detected object",
+                            ["model"])
+
+REQUESTS_IN_FLIGHT = Gauge(
+    "yoso_requests_in_flight",
+    "Inference requests admitted by the executor and not yet answered")
+
+
+def observe_stage(stage: str, model: str, seconds: float):
+    """Record the duration of a pipeline stage of `model`, the `queue_wait`
+    stage and `lock_wait` stage going to their own histograms"""
+    if stage == "queue_wait":
+        QUEUE_WAIT_SECONDS.labels(model=model).observe(seconds)
+    elif stage == "lock_wait":
+        LOCK_WAIT_SECONDS.labels(model=model).observe(seconds)
+    else:
+        STAGE_SECONDS.labels(stage=stage, model=model).observe(seconds)
+
+
+@contextmanager
+def stage_timer(stage: str, model: str):
+    "Time the enclosed block as `stage` of `model`"
+    tic = perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, model, perf_counter() - tic)
+
+
+def observe_detections(model: str, labels):
+    "Count the detections of a prediction by class, or an empty prediction"
+    if not labels:
+        EMPTY_PREDICTIONS.labels(model=model).inc()
+    for label in labels:
+        DETECTIONS.labels(model=model, label=label).inc()
+
 
 def add_metrics(app: FastAPI) -> FastAPI:
     """
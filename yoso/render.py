@@ -0,0 +1,116 @@
+"""
+Rendering of detections onto images, and encoding of the result.
+
+`Renderer` draws boxes by class id with a fixed palette (the same colours
+across restarts and processes), caching the text size of every label it
+draws. The digits of the font all have the same width, so a label with a
+confidence is measured once per number of integer digits. Given a
+`max_dim`, it draws on a downscaled preview of the image instead of the
+full resolution one, which also makes the encoding cheaper.
+"""
+import cv2
+import numpy as np
+
+# digits -> "0", to key the size of a text by its shape only
+ZEROS = str.maketrans("123456789", "000000000")
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# output format -> (extension, media type, OpenCV quality flag)
+FORMATS = {
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+def palette(n: int):
+    """`n` distinct BGR colours, spread around the hue circle by the golden
+    ratio so that neighbouring class ids get contrasting colours"""
+    hues = (np.arange(n) * 0.618033988749895 % 1.0 * 180).astype(np.uint8)
+    hsv = np.stack([hues,
+                    np.full(n, 220, np.uint8),
+                    np.full(n, 255, np.uint8)],
+                   axis=1).reshape(n, 1, 3)
+    bgr = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR).reshape(n, 3)
+    return [tuple(int(c) for c in color) for color in bgr]
+
+
+def preview_scale(shape, max_dim):
+    "Downscaling factor fitting an image of `shape` within `max_dim`"
+    if not max_dim:
+        return 1.0
+    return min(1.0, max_dim / max(shape[:2]))
+
+
+class Renderer:
+    """Draw (bbox, class id, confidence) detections labelled by `classes`,
+    in the given per class `colors` (default: `palette`).
+
+    The label text of a box is drawn over a filled background of the box
+    colour, inside the image even for boxes touching its top edge.
+    """
+
+    def __init__(self,
+                 classes,
+                 colors=None,
+                 font_scale: float = 0.5,
+                 thickness: int = 2):
+        self.classes = list(classes)
+        self.colors = ([tuple(int(c) for c in color) for color in colors]
+                       if colors is not None else palette(len(self.classes)))
+        self.font_scale = font_scale
+        self.thickness = thickness
+        # text with its digits zeroed -> ((width, height), baseline): at most
+        # 4 entries per class, without and with 1 to 3 integer digits
+        self.text_sizes = {}
+
+    def text_size(self, text: str):
+        key = text.translate(ZEROS)
+        size = self.text_sizes.get(key)
+        if size is None:
+            size = cv2.getTextSize(key, FONT, self.font_scale, 1)
+            self.text_sizes[key] = size
+        return size
+
+    def draw(self,
+             image,
+             bbox,
+             class_ids,
+             confidence=None,
+             max_dim: int = None):
+        """Draw the detections on `image`, in place unless a downscaled
+        preview (long side of at most `max_dim`) is asked for. Boxes are in
+        the coordinates of `image`. Returns the annotated image."""
+        scale = preview_scale(image.shape, max_dim)
+        if scale < 1.0:
+            height, width = image.shape[:2]
+            image = cv2.resize(image, (max(1, round(width * scale)),
+                                       max(1, round(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+
+        for i, class_id in enumerate(class_ids):
+            color = self.colors[class_id]
+            x1, y1, x2, y2 = (int(round(v * scale)) for v in bbox[i])
+            cv2.rectangle(image, (x1, y1), (x2, y2), color, self.thickness)
+
+            text = self.classes[class_id]
+            if confidence is not None:
+                text = f"{text} {confidence[i] * 100:.2f}%"
+            (tw, th), baseline = self.text_size(text)
+            # above the box, or just inside it when it touches the top edge
+            top = y1 - th - baseline if y1 - th - baseline >= 0 else y1
+            cv2.rectangle(image, (x1, top), (x1 + tw, top + th + baseline),
+                          color, cv2.FILLED)
+            cv2.putText(image, text, (x1, top + th), FONT, self.font_scale,
+                        (0, 0, 0), 1, cv2.LINE_AA)
+        return image
+
+
+def encode(image, fmt: str = "jpeg", quality: int = 90):
+    """Encode `image` as `fmt` (see `FORMATS`) at `quality` (1-100).
+    Returns the encoded bytes, or None if OpenCV failed to encode it."""
+    extension, _, flag = FORMATS[fmt]
+    ok, encoded = cv2.imencode(extension, image, [flag, int(quality)])
+    if not ok:
+        return None
+    return encoded.tobytes()
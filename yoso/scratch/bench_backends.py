@@ -0,0 +1,109 @@
+"""
+Latency and agreement benchmark of the inference backends.
+
+Runs every image under `./images` through each backend variant, given as
+`runtime:backend:target` (`opencv:default:cpu`, `opencv:opencv:cpu_fp16`,
+`opencv:inference_engine:cpu`...) or `onnxruntime` (ONNX exports found in
+`YOSO_onnx_dir`, see `yoso.model.backends`). Variants the environment
+cannot run are reported and skipped.
+
+Reports the mean detection latency of each variant and its agreement with
+the first one: the F1 score of its detections against the first variant's,
+a pair matching when labels are equal and IoU >= 0.5.
+
+usage (from the repo root):
+`python -m yoso.scratch.bench_backends [model] [repeats] [variant...]`
+"""
+import os
+import sys
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from yoso.model.my_model import DetectionModel
+
+images_dir = "./images"
+default_variants = [
+    "opencv:default:cpu", "opencv:opencv:cpu_fp16",
+    "opencv:inference_engine:cpu", "onnxruntime"
+]
+
+
+def build_model(variant):
+    "DetectionModel running on `variant`"
+    runtime, *rest = variant.split(":")
+    if runtime == "onnxruntime":
+        return DetectionModel(runtime=runtime,
+                              onnx_dir=os.environ.get("YOSO_onnx_dir"))
+    backend, target = rest
+    return DetectionModel(runtime=runtime,
+                          dnn_backend=backend,
+                          dnn_target=target)
+
+
+def iou(a, b):
+    "Intersection over union of two [x1, y1, x2, y2] boxes"
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    union = ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) *
+             (b[3] - b[1]) - inter)
+    return inter / union
+
+
+def agreement(reference, other, min_iou=0.5):
+    "F1 score of the `other` detections against the `reference` ones"
+    ref_boxes, ref_labels, _ = reference
+    boxes, labels, _ = other
+    if not ref_boxes and not boxes:
+        return 1.0
+    unmatched = list(range(len(ref_boxes)))
+    matches = 0
+    for box, label in zip(boxes, labels):
+        for i in unmatched:
+            if ref_labels[i] == label and iou(ref_boxes[i], box) >= min_iou:
+                unmatched.remove(i)
+                matches += 1
+                break
+    return 2 * matches / (len(ref_boxes) + len(boxes))
+
+
+if __name__ == "__main__":
+    model = sys.argv[1] if len(sys.argv) > 1 else "yolov3-tiny"
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    variants = sys.argv[3:] or default_variants
+
+    images = [(name, cv2.imread(os.path.join(images_dir, name)))
+              for name in sorted(os.listdir(images_dir))]
+    images = [(name, image) for name, image in images if image is not None]
+
+    print(f"model={model} repeats={repeats} images={len(images)}")
+    print(f"{'variant':<30}{'backend':<24}{'mean ms':>9}{'agreement':>11}")
+    reference = None
+    for variant in variants:
+        try:
+            od_model = build_model(variant)
+            od_model.preload([model])
+            # first forward pays for OpenCV's allocations
+            od_model.detect_common_objects(images[0][1], model=model)
+        except Exception as e:
+            print(f"{variant:<30}skipped: {e}")
+            continue
+
+        times, results = [], []
+        for _, image in images:
+            for _ in range(repeats):
+                tic = perf_counter()
+                result = od_model.detect_common_objects(image, model=model)
+                times.append(perf_counter() - tic)
+            results.append(result)
+
+        if reference is None:
+            reference = results
+        score = np.mean([agreement(r, o) for r, o in zip(reference, results)])
+        backend = od_model.registry.stats()[model]["backend"]
+        print(f"{variant:<30}{backend:<24}{np.mean(times) * 1e3:>9.2f}"
+              f"{score:>11.3f}")
@@ -0,0 +1,111 @@
+"""
+Micro-benchmark of the yolo output decoding.
+
+Compares the per-row python loop `DetectionModel` used to decode the
+network outputs with the vectorized `DetectionModel.postprocess`, on the
+raw outputs of every image under `./images`.
+
+usage (from the repo root):
+`python -m yoso.scratch.bench_postprocess [model] [repeats]`
+"""
+import os
+import sys
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from yoso.model.my_model import DetectionModel
+
+images_dir = "./images"
+
+
+def loop_postprocess(classes, outs, shape, confidence, nms_thresh):
+    "The original row by row decoding, kept as a reference"
+    Height, Width = shape
+
+    class_ids = []
+    confidences = []
+    boxes = []
+
+    for out in outs:
+        for detection in out:
+            scores = detection[5:]
+            class_id = np.argmax(scores)
+            max_conf = scores[class_id]
+            if max_conf > confidence:
+                center_x = int(detection[0] * Width)
+                center_y = int(detection[1] * Height)
+                w = int(detection[2] * Width)
+                h = int(detection[3] * Height)
+                x = center_x - (w / 2)
+                y = center_y - (h / 2)
+                class_ids.append(class_id)
+                confidences.append(float(max_conf))
+                boxes.append([x, y, w, h])
+
+    indices = cv2.dnn.NMSBoxes(boxes, confidences, confidence, nms_thresh)
+
+    bbox = []
+    label = []
+    conf = []
+
+    for i in np.asarray(indices, dtype=np.int64).reshape(-1):
+        x, y, w, h = boxes[i]
+        bbox.append([int(x), int(y), int(x + w), int(y + h)])
+        label.append(str(classes[class_ids[i]]))
+        conf.append(confidences[i])
+
+    return bbox, label, conf
+
+
+def timeit(fn, repeats):
+    "Mean and std of the wall time of `fn()` over `repeats` calls"
+    times = []
+    for _ in range(repeats):
+        tic = perf_counter()
+        fn()
+        times.append(perf_counter() - tic)
+    return np.mean(times), np.std(times)
+
+
+if __name__ == "__main__":
+    model = sys.argv[1] if len(sys.argv) > 1 else "yolov3-tiny"
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    confidence, nms_thresh = 0.5, 0.3
+
+    od_model = DetectionModel()
+    od_model.preload([model])
+    classes = od_model.classes
+
+    print(f"model={model} repeats={repeats}")
+    print(f"{'image':<14}{'rows':>8}{'loop ms':>12}{'numpy ms':>12}"
+          f"{'speedup':>10}")
+    totals = [0.0, 0.0]
+    for name in sorted(os.listdir(images_dir)):
+        image = cv2.imread(os.path.join(images_dir, name))
+        if image is None:
+            continue
+        outs = od_model.forward([image], model)[0]
+        shape = image.shape[:2]
+        rows = sum(len(out) for out in outs)
+
+        expected = loop_postprocess(classes, outs, shape, confidence,
+                                    nms_thresh)
+        got = od_model.postprocess(outs, shape, confidence, nms_thresh)
+        assert expected[0] == got[0] and expected[1] == got[1], \
+            f"decoding mismatch on {name}"
+
+        loop_t, _ = timeit(
+            lambda: loop_postprocess(classes, outs, shape, confidence,
+                                     nms_thresh), repeats)
+        numpy_t, _ = timeit(
+            lambda: od_model.postprocess(outs, shape, confidence, nms_thresh),
+            repeats)
+        totals[0] += loop_t
+        totals[1] += numpy_t
+        print(f"{name:<14}{rows:>8}{loop_t * 1e3:>12.3f}"
+              f"{numpy_t * 1e3:>12.3f}{loop_t / numpy_t:>9.1f}x")
+
+    print(f"{'total':<14}{'':>8}{totals[0] * 1e3:>12.3f}"
+          f"{totals[1] * 1e3:>12.3f}{totals[0] / totals[1]:>9.1f}x")
@@ -0,0 +1,83 @@
+"""
+Allocation benchmark of the upload decoding.
+
+Compares, on every image under `./images`, the original `file_to_cv_image`
+(BytesIO -> bytes -> bytearray -> np.asarray copies) with
+`yoso.cvutils.decode_upload`, the path of the server (`upload_bytes`, which
+shares the buffer of in-memory uploads, then `decode_image`), optionally
+decoding at reduced resolution.
+
+Reports the python-side memory allocated per request (`tracemalloc` peak,
+numpy buffers included; OpenCV's own allocations are not traced) and the
+decode time.
+
+usage (from the repo root):
+`python -m yoso.scratch.bench_upload_decode [reduce_to] [repeats]`
+"""
+import io
+import os
+import sys
+import tracemalloc
+from tempfile import SpooledTemporaryFile
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from yoso.cvutils import decode_upload
+
+images_dir = "./images"
+# same spooling threshold as starlette's UploadFile
+spool_max_size = 1024 * 1024
+
+
+class FakeUpload:
+    "Minimal stand-in for `fastapi.UploadFile`, both decoders only use `.file`"
+
+    def __init__(self, content: bytes):
+        self.file = SpooledTemporaryFile(max_size=spool_max_size)
+        self.file.write(content)
+        self.file.seek(0)
+
+
+def copying_file_to_cv_image(file):
+    "The original decoding path, kept as a reference"
+    image_stream = io.BytesIO(file.file.read())
+    image_stream.seek(0)
+    file_bytes = np.asarray(bytearray(image_stream.read()), dtype=np.uint8)
+    return cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+
+
+def measure(decode, content, repeats):
+    "Mean python-side peak allocation (bytes) and time (s) of `decode`"
+    peaks, times = [], []
+    for _ in range(repeats):
+        upload = FakeUpload(content)
+        tracemalloc.start()
+        tic = perf_counter()
+        decode(upload)
+        times.append(perf_counter() - tic)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+    return np.mean(peaks), np.mean(times)
+
+
+if __name__ == "__main__":
+    reduce_to = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    print(f"reduce_to={reduce_to} repeats={repeats}")
+    print(f"{'image':<14}{'size KB':>9}{'before KB':>11}{'after KB':>10}"
+          f"{'before ms':>11}{'after ms':>10}")
+    for name in sorted(os.listdir(images_dir)):
+        with open(os.path.join(images_dir, name), "rb") as f:
+            content = f.read()
+
+        before_mem, before_t = measure(copying_file_to_cv_image, content,
+                                       repeats)
+        after_mem, after_t = measure(
+            lambda upload: decode_upload(upload, reduce_to), content, repeats)
+        print(f"{name:<14}{len(content) / 1024:>9.1f}"
+              f"{before_mem / 1024:>11.1f}{after_mem / 1024:>10.1f}"
+              f"{before_t * 1e3:>11.2f}{after_t * 1e3:>10.2f}")
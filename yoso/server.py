@@ -29,7 +29,7 @@ import yoso.tracer as ytrace
 
 
 class Server:
-    instrument_exclude_urls = "metrics"
+    instrument_exclude_urls = "metrics,health,ready"
 
     def __init__(self, conf: ServerConfig):
         self.conf = conf
@@ -46,11 +46,12 @@ class Server:
         console.log("Upload directory is: ", self.conf.upload_dir)
         # setup logging/monitoring/audit tooling
         self.app = self._resolve_handler()
-        # avoid logging metrics requests
+        # avoid logging metrics and probe requests
         logging.getLogger("uvicorn.access").addFilter(
-            utils.EndpointLogFilter(["/metrics"]))
-        # TODO:
-        # - make sure models are loaded to avoid cold start requests
+            utils.EndpointLogFilter(["/metrics", "/health", "/ready"]))
+        # models are loaded and warmed up by the app's startup handler,
+        # as the app may be imported by uvicorn in its own process:
+        # `/ready` answers 503 until that is done
 
     def _resolve_otel_manager(self):
         "Determine the instrumentation manager class to use"
@@ -0,0 +1,45 @@
+"""
+Per-connection backpressure of the `/stream` WebSocket endpoint.
+
+Frames are received as fast as the client sends them, but only the newest
+one waiting for inference is kept: when detection falls behind, the
+older pending frame is dropped instead of queueing without bound. The
+latest frame sent is therefore always processed.
+"""
+import asyncio
+
+from yoso.prometheus import STREAM_FRAMES
+
+
+class LatestFrame:
+    """Single slot mailbox between the receiving and the detecting side of
+    a stream. Must be used from the event loop thread."""
+
+    def __init__(self):
+        self.frame = None
+        self.dropped = 0
+        self.closed = False
+        self.event = asyncio.Event()
+
+    def put(self, seq: int, content: bytes):
+        "Offer frame number `seq`, replacing the pending one if any"
+        if self.frame is not None:
+            self.dropped += 1
+            STREAM_FRAMES.labels(outcome="dropped").inc()
+        self.frame = (seq, content)
+        self.event.set()
+
+    def close(self):
+        "No more frames will come, wakes up `get` once the slot is empty"
+        self.closed = True
+        self.event.set()
+
+    async def get(self):
+        "Wait for the newest frame as (seq, content), None once closed"
+        while self.frame is None:
+            if self.closed:
+                return None
+            self.event.clear()
+            await self.event.wait()
+        frame, self.frame = self.frame, None
+        return frame
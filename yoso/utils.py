@@ -1,8 +1,18 @@
+import io
 import os
+import shutil
+import tarfile
+import zipfile
 from yoso.console import console
+from yoso.cvutils import image_format, image_size
+from yoso.prometheus import REQUESTS_REJECTED
 from fastapi import UploadFile, HTTPException
 import logging
-from typing import List
+from typing import List, Optional, Tuple
+
+IMAGE_EXTS = {"jpg", "jpeg", "png"}
+ARCHIVE_EXTS = (".zip", ".tar", ".tar.gz", ".tgz")
+VIDEO_EXTS = {"mp4", "avi", "mov", "mkv", "webm"}
 
 
 def ensure_upload_dir(the_dir):
@@ -12,13 +22,162 @@ def ensure_upload_dir(the_dir):
         os.mkdir(the_dir)
 
 
-def validate_image_file(file: UploadFile, exts={"jpg", "jpeg", "png"}):
-    """Validate the extension of the some uploaded file."""
-    filename = file.filename
+def reject(status_code: int, reason: str, detail: str):
+    """Count a rejected input on `/metrics` by `reason`, and return the
+    HTTPException to raise"""
+    REQUESTS_REJECTED.labels(reason=reason).inc()
+    return HTTPException(status_code=status_code, detail=detail)
+
+
+def validate_filename(filename: str, exts=IMAGE_EXTS):
+    """Validate the extension of some file name."""
     fileExtension = filename.split(".")[-1] in exts
     if not fileExtension:
-        raise HTTPException(status_code=415,
-                            detail="Unsupported file provided.")
+        raise reject(415, "unsupported_type", "Unsupported file provided.")
+
+
+def validate_upload_size(file: UploadFile, max_bytes: int = 0):
+    """Reject an upload larger than `max_bytes` (0: no limit) before it is
+    read, from the size of its spooled file."""
+    if max_bytes <= 0:
+        return
+    spooled = file.file
+    position = spooled.tell()
+    spooled.seek(0, os.SEEK_END)
+    size = spooled.tell()
+    spooled.seek(position)
+    if size > max_bytes:
+        raise reject(413, "too_large",
+                     f"Uploads are limited to {max_bytes} bytes.")
+
+
+def validate_image_content(buf, max_bytes: int = 0, max_pixels: int = 0):
+    """Validate an encoded image without decoding it: its byte size, its
+    format from the magic bytes, and its pixel count from the header.
+    Limits of 0 are not enforced.
+    Returns:
+        The (width, height) of the image
+    """
+    if max_bytes > 0 and len(buf) > max_bytes:
+        raise reject(413, "too_large",
+                     f"Images are limited to {max_bytes} bytes.")
+    if image_format(buf) is None:
+        raise reject(415, "unsupported_format",
+                     "Only JPEG and PNG images are supported.")
+    dims = image_size(buf)
+    if dims is None or 0 in dims:
+        raise reject(400, "malformed", "Could not read the image header.")
+    width, height = dims
+    if max_pixels > 0 and width * height > max_pixels:
+        raise reject(413, "too_many_pixels",
+                     f"Images are limited to {max_pixels} pixels.")
+    return width, height
+
+
+def validate_image_file(file: UploadFile, exts=IMAGE_EXTS):
+    """Validate the extension of the some uploaded file."""
+    validate_filename(file.filename, exts)
+
+
+def is_archive(filename: str):
+    """Whether `filename` names a zip or tar archive."""
+    return filename.lower().endswith(ARCHIVE_EXTS)
+
+
+def validate_batch_file(file: UploadFile, exts=IMAGE_EXTS):
+    """Validate the extension of a file uploaded to a batch endpoint:
+    either an image or an archive of images."""
+    if not is_archive(file.filename):
+        validate_image_file(file, exts)
+
+
+def expand_archive(filename: str,
+                   content: bytes,
+                   exts=IMAGE_EXTS,
+                   max_images: Optional[int] = None,
+                   max_image_bytes: Optional[int] = None,
+                   max_total_bytes: Optional[int] = None
+                   ) -> List[Tuple[str, bytes]]:
+    """List the (name, content) of the images found in a zip or tar archive.
+
+    Member names are reduced to their base name, other members are skipped.
+    The limits (None: no limit) on the number of images, the uncompressed
+    size of each and their total are checked against the member headers.
+    A zip's central directory lists them all, so they are checked before
+    anything is decompressed. A tar is read as a stream, one header at a
+    time: each member is checked before its data is decompressed, and
+    `max_total_bytes` bounds the whole expanded stream (headers and skipped
+    members included). zipfile and tarfile never read more than the size a
+    member declares.
+    """
+
+    def is_image(name):
+        return name.split(".")[-1].lower() in exts
+
+    def check(sizes):
+        if max_images is not None and len(sizes) > max_images:
+            raise reject(413, "too_many_images",
+                         f"Too many images in archive {filename}.")
+        if max_image_bytes is not None and any(size > max_image_bytes
+                                               for size in sizes):
+            raise reject(413, "too_large",
+                         f"Images are limited to {max_image_bytes} bytes.")
+        if max_total_bytes is not None and sum(sizes) > max_total_bytes:
+            raise reject(413, "too_large",
+                         f"Archive {filename} is too large once expanded.")
+
+    try:
+        if filename.lower().endswith(".zip"):
+            with zipfile.ZipFile(io.BytesIO(content)) as archive:
+                infos = [
+                    info for info in archive.infolist()
+                    if not info.is_dir() and is_image(info.filename)
+                ]
+                check([info.file_size for info in infos])
+                return [(os.path.basename(info.filename), archive.read(info))
+                        for info in infos]
+        # getmembers() would decompress the whole archive first
+        images, sizes = [], []
+        with tarfile.open(fileobj=io.BytesIO(content), mode="r|*") as archive:
+            for member in archive:
+                if (max_total_bytes is not None and
+                        member.offset_data + member.size > max_total_bytes):
+                    raise reject(
+                        413, "too_large",
+                        f"Archive {filename} is too large once expanded.")
+                if not (member.isfile() and is_image(member.name)):
+                    continue
+                sizes.append(member.size)
+                check(sizes)
+                images.append((os.path.basename(member.name),
+                               archive.extractfile(member).read()))
+        return images
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        raise HTTPException(status_code=400,
+                            detail=f"Invalid archive {filename}: {e}")
+
+
+def save_upload(file: UploadFile, dest: str):
+    """Copy an uploaded file to `dest`, in chunks."""
+    file.file.seek(0)
+    with open(dest, "wb") as out:
+        shutil.copyfileobj(file.file, out)
+
+
+def resolve_local_file(path: str, root: str):
+    """Resolve a server-side `path` given by a client, which must name an
+    existing file under the `root` directory."""
+    if not root:
+        raise HTTPException(status_code=403,
+                            detail="Local paths are not accepted.")
+    root = os.path.realpath(root)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise HTTPException(status_code=403,
+                            detail="Path outside of the input directory.")
+    if not os.path.isfile(resolved):
+        raise HTTPException(status_code=404, detail="File not found.")
+    return resolved
 
 
 class EndpointLogFilter(logging.Filter):
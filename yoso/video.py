@@ -0,0 +1,308 @@
+"""
+Background processing of recorded video files.
+
+A job decodes its video with `cv2.VideoCapture` on a background thread and
+samples one frame every `step` (skipped frames are grabbed, not decoded).
+Sampled frames are submitted to the detector with up to `max_in_flight`
+of them pending at once, so that the batch scheduler can group them into
+shared forward passes. Detections are written as one JSON line per sampled
+frame, and optionally an annotated video of the sampled frames.
+
+With `motion`, sampled frames go through a `yoso.motion.FrameDiffer` first,
+and those that did not change reuse the previous detections.
+
+Finished jobs and their outputs are kept for `ttl` seconds, and at most
+`max_jobs` of them, unless deleted before.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import cv2
+
+from yoso.console import console
+from yoso.motion import FrameDiffer
+from yoso.prometheus import VIDEO_FRAMES
+
+
+def sample_step(source_fps, every_n=1, target_fps=None):
+    """Keep one frame every returned step: `every_n`, or the step closest to
+    `target_fps` when it is set and the source frame rate is known"""
+    if target_fps and source_fps > 0:
+        return max(1, round(source_fps / target_fps))
+    return max(1, every_n)
+
+
+class VideoJob:
+    "State and progress of a video processing job"
+
+    def __init__(self, job_id, name, source, directory, model, confidence,
+                 every_n, target_fps, annotated, cleanup, motion=False,
+                 size=None):
+        self.id = job_id
+        self.name = name
+        self.source = source
+        self.model = getattr(model, "value", model)
+        self.confidence = confidence
+        self.every_n = every_n
+        self.target_fps = target_fps
+        # remove `source` once done (uploaded videos)
+        self.cleanup = cleanup
+        self.motion = motion
+        # network input size, None for the model's
+        self.size = size
+        self.directory = directory
+        self.detections_path = os.path.join(directory, "detections.jsonl")
+        self.video_path = (os.path.join(directory, "annotated.avi")
+                           if annotated else None)
+
+        self.status = "queued"
+        self.error = None
+        self.step = every_n
+        self.source_fps = 0.0
+        self.frames_total = 0
+        self.frames_read = 0
+        self.frames_processed = 0
+        self.frames_skipped = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def fps(self):
+        "Throughput, in sampled frames processed per second"
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return self.frames_processed / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def progress(self):
+        "Fraction of the video read so far"
+        if self.status == "done":
+            return 1.0
+        if self.frames_total <= 0:
+            return 0.0
+        return min(1.0, self.frames_read / self.frames_total)
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "model": self.model,
+            "sample_step": self.step,
+            "source_fps": self.source_fps,
+            "frames_total": self.frames_total,
+            "frames_read": self.frames_read,
+            "frames_processed": self.frames_processed,
+            "frames_skipped": self.frames_skipped,
+            "progress": self.progress,
+            "fps": self.fps,
+            "annotated": self.video_path is not None,
+            "error": self.error,
+        }
+
+
+class VideoJobManager:
+    """Run video jobs on `workers` background threads, writing their outputs
+    under `directory/<job id>/`.
+
+    `detector` is a `BatchScheduler` or `WorkerPool` (anything with `submit`),
+    `draw(image, bbox, label, conf)` annotates a frame in place and
+    `differ_factory()` builds the `FrameDiffer` of the jobs using `motion`.
+    Finished jobs are removed, with their outputs, `ttl` seconds after they
+    finished and beyond the `max_jobs` most recent (0: no limit).
+    """
+
+    def __init__(self,
+                 detector,
+                 draw,
+                 directory: str,
+                 nms_thresh: float = 0.3,
+                 workers: int = 1,
+                 max_in_flight: int = 16,
+                 differ_factory=FrameDiffer,
+                 max_jobs: int = 100,
+                 ttl: float = 24 * 3600):
+        assert max_in_flight >= 1, "max_in_flight must be at least 1"
+        self.detector = detector
+        self.draw = draw
+        self.directory = directory
+        self.nms_thresh = nms_thresh
+        self.max_in_flight = max_in_flight
+        self.differ_factory = differ_factory
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix="yoso-video")
+        os.makedirs(os.path.join(directory, "uploads"), exist_ok=True)
+
+    def upload_path(self, filename: str):
+        "Unique path where to save an uploaded video before processing it"
+        return os.path.join(self.directory, "uploads",
+                            f"{uuid4().hex}-{os.path.basename(filename)}")
+
+    def create(self,
+               source: str,
+               model,
+               confidence: float = 0.5,
+               every_n: int = 1,
+               target_fps: float = None,
+               annotated: bool = False,
+               name: str = None,
+               cleanup: bool = False,
+               motion: bool = False,
+               size: int = None) -> VideoJob:
+        "Queue a job processing the video file at `source`"
+        job_id = uuid4().hex
+        directory = os.path.join(self.directory, job_id)
+        os.makedirs(directory)
+        job = VideoJob(job_id, name or os.path.basename(source), source,
+                       directory, model, confidence, every_n, target_fps,
+                       annotated, cleanup, motion, size)
+        with self.lock:
+            self.jobs[job_id] = job
+        self.pool.submit(self._run, job)
+        self.prune()
+        return job
+
+    def get(self, job_id: str):
+        "The job `job_id`, or None"
+        return self.jobs.get(job_id)
+
+    def list(self):
+        self.prune()
+        with self.lock:
+            return list(self.jobs.values())
+
+    def remove(self, job: VideoJob):
+        "Forget a finished job and delete its outputs"
+        with self.lock:
+            self.jobs.pop(job.id, None)
+        shutil.rmtree(job.directory, ignore_errors=True)
+
+    def prune(self):
+        "Remove the finished jobs past their retention"
+        now = time.monotonic()
+        with self.lock:
+            finished = [
+                job for job in self.jobs.values() if job.finished is not None
+            ]
+        # oldest first
+        finished.sort(key=lambda job: job.finished)
+        expired = [
+            job for job in finished
+            if self.ttl > 0 and now - job.finished > self.ttl
+        ]
+        kept = len(finished) - len(expired)
+        if self.max_jobs > 0 and kept > self.max_jobs:
+            expired += finished[len(expired):][:kept - self.max_jobs]
+        for job in expired:
+            self.remove(job)
+
+    def _run(self, job: VideoJob):
+        job.status = "running"
+        job.started = time.monotonic()
+        capture = cv2.VideoCapture(job.source)
+        writer = None
+        differ = self.differ_factory() if job.motion else None
+        try:
+            if not capture.isOpened():
+                raise ValueError("Could not open the video.")
+            job.source_fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+            job.frames_total = max(
+                0, int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0))
+            job.step = sample_step(job.source_fps, job.every_n,
+                                   job.target_fps)
+
+            # (frame index, frame, decision, roi, future of its detections
+            # or None when skipped), in order
+            pending = deque()
+            with open(job.detections_path, "w") as out:
+                index = 0
+                while True:
+                    if index % job.step == 0:
+                        ok, frame = capture.read()
+                        if not ok:
+                            break
+                        decision, roi = "full", None
+                        if differ is not None:
+                            decision, roi = differ.decide(frame)
+                        future = None
+                        if decision != "skip":
+                            future = self.detector.submit(
+                                frame if roi is None else differ.crop(
+                                    frame, roi),
+                                confidence=job.confidence,
+                                nms_thresh=self.nms_thresh,
+                                model=job.model,
+                                size=job.size)
+                        pending.append((index, frame, decision, roi, future))
+                    elif not capture.grab():
+                        break
+                    index += 1
+                    job.frames_read = index
+                    if len(pending) >= self.max_in_flight:
+                        writer = self._write(job, out, writer, differ,
+                                             *pending.popleft())
+                while pending:
+                    writer = self._write(job, out, writer, differ,
+                                         *pending.popleft())
+            job.frames_total = job.frames_read
+            job.status = "done"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            console.log(f"[red]Video job {job.id} failed: {e!r}[/]")
+        finally:
+            job.finished = time.monotonic()
+            capture.release()
+            if writer is not None:
+                writer.release()
+            if job.cleanup:
+                try:
+                    os.remove(job.source)
+                except OSError:
+                    pass
+            self.prune()
+
+    def _write(self, job, out, writer, differ, index, frame, decision, roi,
+               future):
+        "Record the detections of a sampled frame, returns the video writer"
+        detections = None if future is None else future.result()
+        if differ is not None:
+            # in frame order, so skipped frames reuse the right detections
+            detections = differ.resolve(decision, roi, detections)
+        bbox, label, conf = detections
+        out.write(
+            json.dumps({
+                "frame": index,
+                "time": index / job.source_fps if job.source_fps else None,
+                "detections": [{
+                    "label": l,
+                    "confidence": c,
+                    "box": b
+                } for b, l, c in zip(bbox, label, conf)],
+            }) + "\n")
+        job.frames_processed += 1
+        if future is None:
+            job.frames_skipped += 1
+        else:
+            VIDEO_FRAMES.labels(model=job.model).inc()
+
+        if job.video_path is not None:
+            if writer is None:
+                height, width = frame.shape[:2]
+                fps = job.source_fps / job.step if job.source_fps else 1.0
+                writer = cv2.VideoWriter(job.video_path,
+                                         cv2.VideoWriter_fourcc(*"MJPG"),
+                                         fps, (width, height))
+            writer.write(self.draw(frame, bbox, label, conf))
+        return writer
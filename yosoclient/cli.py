@@ -23,11 +23,20 @@ def check_extension(x):
 
 @click.group(help="Command line client for YOSO prediction service")
 @click.option("--confidence", default=0.5, type=click.FLOAT)
+@click.option("--resize",
+              type=click.IntRange(min=1),
+              help="Downscale images to this long edge before upload")
+@click.option("--quality",
+              type=click.IntRange(1, 100),
+              help="JPEG quality of the downscaled images")
 @click.pass_context
-def cli(ctx: click.Context, confidence):
+def cli(ctx: click.Context, confidence, resize, quality):
     ctx.ensure_object(dict)
     ctx.obj["confidence"] = confidence
-    pass
+    if resize is not None:
+        config.resize_long_edge = resize
+    if quality is not None:
+        config.jpeg_quality = quality
 
 
 @cli.command(help="Predict bounding boxes and labels for a single image")
@@ -45,7 +54,12 @@ def predict_one(ctx, file, dest_dir):
 @click.pass_context
 @click.option("--source-dir", type=click.Path(exists=True), required=True)
 @click.option("--dest-dir", type=click.Path(exists=True), required=True)
-def predict_all(ctx, source_dir, dest_dir):
+@click.option("--concurrency",
+              type=click.IntRange(min=1),
+              default=1,
+              show_default=True,
+              help="Requests in flight at once (pipelined when above 1)")
+def predict_all(ctx, source_dir, dest_dir, concurrency):
     assert os.path.isdir(source_dir), "--source-dir must be a directory"
     assert os.path.isdir(dest_dir), "--dest-dir must be a directory"
 
@@ -56,6 +70,18 @@ def predict_all(ctx, source_dir, dest_dir):
 
     assert len(paths) > 0, "--source-dir must contain at least one image file"
 
+    if concurrency > 1:
+        outcomes = client.predict_all(paths,
+                                      dest_dir=dest_dir,
+                                      confidence=ctx.obj["confidence"],
+                                      concurrency=concurrency)
+        failed = [path for path, code in outcomes.items() if code != 200]
+        console.log(f"{len(paths) - len(failed)}/{len(paths)} images "
+                    f"predicted")
+        for path in failed:
+            console.log(f"[red]{path}: {outcomes[path]!r}[/]")
+        return
+
     for path in paths:
         console.log(f"[green]Predict request for {path}[/]")
         client.predict_request(path,
@@ -71,5 +97,36 @@ def count_objects(ctx, file):
     pprint(data)
 
 
+@cli.command(help="Detect objects in a single image, returning their boxes")
+@click.pass_context
+@click.option("--file", type=click.Path(exists=True), required=True)
+def detect(ctx, file):
+    data = client.detect_request(file, confidence=ctx.obj["confidence"])
+    pprint(data)
+
+
+@cli.command(help="Stream a directory of images or a video file for detection")
+@click.pass_context
+@click.option("--source", type=click.Path(exists=True), required=True)
+@click.option("--fps", type=click.FLOAT, help="Pace the frames sent")
+@click.option("--motion",
+              is_flag=True,
+              help="Reuse detections for frames that did not change")
+def stream(ctx, source, fps, motion):
+
+    def show(result):
+        labels = [d["label"] for d in result["detections"]]
+        console.log(f"[green]frame {result['frame']}[/] "
+                    f"(dropped {result['dropped']}): "
+                    f"{result['error'] or labels}")
+
+    results = client.stream(source,
+                            confidence=ctx.obj["confidence"],
+                            fps=fps,
+                            motion=motion,
+                            on_result=show)
+    console.log(f"{len(results)} frames processed")
+
+
 if __name__ == "__main__":
     cli(obj={})
@@ -10,6 +10,14 @@ class ClientConfig(BaseSettings):
     model: str = "yolov3-tiny"
     response_image_dir: str = "./images_predicted"
     accepted_formats: Set[str] = {".jpg", ".jpeg", ".png"}
+    # kept-alive connections to the server, and requests in flight at once
+    # (plus response decoding/saving threads) of the concurrent mode
+    pool_size: int = 10
+    concurrency: int = 4
+    # opt-in downscaling of the images to this long edge (0: off) before
+    # upload, re-encoded as JPEG at `jpeg_quality`
+    resize_long_edge: int = 0
+    jpeg_quality: int = 90
 
     class Config:
         env_prefix = "YOSO_CLIENT_"
@@ -4,9 +4,15 @@ Can be used programmatically from python, or exposed as cli (see yosoclient.cli)
 """
 import os
 import io
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 import cv2
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
+import websockets
 from yosoclient.config import ClientConfig
 from yosoclient.console import console
 import json
@@ -25,11 +31,69 @@ def img_from_response(response: requests.Response):
     return cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
 
 
+def downscale(content: bytes, long_edge: int, quality: int = 90):
+    """Downscale an encoded image to `long_edge` and re-encode it as JPEG at
+    `quality`. Images already small enough are returned untouched.
+    Returns the encoded image and its original (width, height), or None
+    when it was not resized."""
+    image = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return content, None
+    height, width = image.shape[:2]
+    scale = long_edge / max(height, width)
+    if scale >= 1:
+        return content, None
+    image = cv2.resize(image, (max(1, round(width * scale)),
+                               max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode(".jpg", image,
+                               [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        return content, None
+    return encoded.tobytes(), (width, height)
+
+
+def iter_frames(source: str, accepted_formats):
+    """Yield the encoded frames of `source`: the image files of a directory,
+    in name order, or the frames of a video file, encoded as JPEG"""
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if os.path.splitext(name)[1] in accepted_formats:
+                with open(os.path.join(source, name), "rb") as f:
+                    yield f.read()
+        return
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video file {source}")
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            ok, encoded = cv2.imencode(".jpg", frame)
+            if ok:
+                yield encoded.tobytes()
+    finally:
+        capture.release()
+
+
 class Client:
-    """Client wrapper for the prediction API"""
+    """Client wrapper for the prediction API.
+
+    Requests go through a `requests.Session` keeping up to `pool_size`
+    connections alive, rather than opening one per image. `predict_many`
+    is the asyncio (httpx) variant, with several requests in flight.
+
+    With `resize_long_edge` set, images are downscaled and re-encoded before
+    upload (see `prepare`): annotated images come back at the reduced size,
+    while `/detect` boxes are mapped back to the original image.
+    """
 
     def __init__(self, conf: ClientConfig):
         self.conf = conf
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=conf.pool_size)
+        self.session.mount("http://", adapter)
 
     def mk_url(self, endpoint: str):
         "Produce the url string for some endpoint"
@@ -39,6 +103,21 @@ class Client:
         raise Exception(
             f"The reqest to {url} was not successfull. CODE={code}")
 
+    def prepare(self, image_path: str):
+        """Read an image to upload, downscaled if `resize_long_edge` is set.
+        Returns the upload's file name and content, and the original
+        (width, height) of a downscaled image (None otherwise)."""
+        base_name = os.path.basename(image_path)
+        with open(image_path, "rb") as image_file:
+            content = image_file.read()
+        if not self.conf.resize_long_edge:
+            return base_name, content, None
+        content, original = downscale(content, self.conf.resize_long_edge,
+                                      self.conf.jpeg_quality)
+        if original is not None:
+            base_name = os.path.splitext(base_name)[0] + ".jpg"
+        return base_name, content, original
+
     def response_from_server(self,
                              url: str,
                              image_file,
@@ -52,7 +131,7 @@ class Client:
         console.log(
             f"[yellow]Request to prediction server at url: {url_with_confidence}[/]"
         )
-        resp = requests.post(url_with_confidence, files=files)
+        resp = self.session.post(url_with_confidence, files=files)
         status_code = resp.status_code
         if verbose:
             msg = "Everything went well!" if status_code == 200 else "There was an error when handling the request."
@@ -60,10 +139,11 @@ class Client:
         return resp
 
     def save_img_from_response(self,
-                               response: requests.Response,
+                               response,
                                filename="latest_response.jpeg",
                                dest_dir=None):
-        """Decode image from response and save under `filename` within `dest_dir`
+        """Decode image from response (`requests` or `httpx`) and save under
+        `filename` within `dest_dir`
         """
         image = img_from_response(response)
         dest_dir = self.conf.response_image_dir if dest_dir is None else dest_dir
@@ -78,34 +158,178 @@ class Client:
         """
         url = self.mk_url("predict")
         base_name = os.path.basename(image_path)
-        with open(image_path, "rb") as image_file:
-            resp = self.response_from_server(
-                url,
-                image_file,
-                confidence=confidence,
-            )
+        upload_name, content, _ = self.prepare(image_path)
+        resp = self.response_from_server(
+            url,
+            (upload_name, content),
+            confidence=confidence,
+        )
+        if resp.status_code == 200:
+            self.save_img_from_response(resp,
+                                        filename=base_name,
+                                        dest_dir=dest_dir)
+        else:
+            self.request_error(resp.url, resp.status_code)
+
+        return resp
+
+    async def predict_many(self,
+                           image_paths,
+                           confidence=0.5,
+                           dest_dir=None,
+                           concurrency=None):
+        """Make /predict requests for all of `image_paths`, with up to
+        `concurrency` (default: the configured one) of them in flight, and
+        save the image responses as `predict_request` does. Decoding and
+        saving run on a thread pool, so uploads keep flowing meanwhile.
+        Returns a dict of image path to response status code, or to the
+        exception raised by its request.
+        """
+        concurrency = concurrency or self.conf.concurrency
+        url = with_confidence(self.mk_url("predict"), confidence)
+        limits = httpx.Limits(max_connections=concurrency,
+                              max_keepalive_connections=concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+        loop = asyncio.get_running_loop()
+        console.log(f"[yellow]Requests to prediction server at url: {url} "
+                    f"({concurrency} at once)[/]")
+
+        async def predict_one(client, path):
+            base_name = os.path.basename(path)
+            async with semaphore:
+                upload_name, content, _ = await loop.run_in_executor(
+                    pool, self.prepare, path)
+                files = {"file": (upload_name, content)}
+                resp = await client.post(url, files=files)
             if resp.status_code == 200:
-                self.save_img_from_response(resp,
-                                            filename=base_name,
-                                            dest_dir=dest_dir)
+                await loop.run_in_executor(pool, self.save_img_from_response,
+                                           resp, base_name, dest_dir)
             else:
-                self.request_error(resp.url, resp.status_code)
+                console.log(f"[red]{path}: CODE={resp.status_code}[/]")
+            return resp.status_code
 
-            return resp
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            async with httpx.AsyncClient(limits=limits,
+                                         timeout=None) as client:
+                outcomes = await asyncio.gather(
+                    *[predict_one(client, path) for path in image_paths],
+                    return_exceptions=True)
+        return dict(zip(image_paths, outcomes))
+
+    def predict_all(self,
+                    image_paths,
+                    confidence=0.5,
+                    dest_dir=None,
+                    concurrency=None):
+        "Blocking wrapper of `predict_many`"
+        return asyncio.run(
+            self.predict_many(image_paths,
+                              confidence=confidence,
+                              dest_dir=dest_dir,
+                              concurrency=concurrency))
 
     def count_objects_request(self, image_path: str, confidence=0.5):
         """
         Make a /count_objects request to the server and return the json decoded response.
         """
         url = self.mk_url("count_objects")
-        with open(image_path, "rb") as image_file:
-            resp = self.response_from_server(url,
-                                             image_file,
-                                             confidence=confidence)
-            if resp.status_code == 200:
-                return resp.json()
-            else:
-                self.request_error(resp.url, resp.status_code)
+        upload_name, content, _ = self.prepare(image_path)
+        resp = self.response_from_server(url, (upload_name, content),
+                                         confidence=confidence)
+        if resp.status_code == 200:
+            return resp.json()
+        else:
+            self.request_error(resp.url, resp.status_code)
+
+    def detect_request(self, image_path: str, confidence=0.5):
+        """
+        Make a /detect request to the server and return the json decoded
+        detections, with boxes in the coordinates of the image at `image_path`
+        even when it was downscaled before upload.
+        """
+        url = self.mk_url("detect")
+        upload_name, content, original = self.prepare(image_path)
+        if original is not None:
+            url += f"&orig_width={original[0]}&orig_height={original[1]}"
+        resp = self.response_from_server(url, (upload_name, content),
+                                         confidence=confidence)
+        if resp.status_code == 200:
+            return resp.json()
+        else:
+            self.request_error(resp.url, resp.status_code)
+
+    async def stream_frames(self,
+                            frames,
+                            confidence=0.5,
+                            fps=None,
+                            motion=False,
+                            on_result=None):
+        """Send `frames` to the /stream endpoint, optionally paced at `fps`,
+        and collect the detections sent back as decoded json messages.
+        With `motion`, the server reuses the last detections for frames that
+        did not change.
+
+        The server may drop frames when it falls behind, but always answers
+        the last one: the stream ends once its result has arrived.
+        """
+        url = self.mk_url("stream").replace("http://", "ws://", 1)
+        url = with_confidence(url, confidence)
+        if motion:
+            url += "&motion=true"
+        console.log(f"[yellow]Streaming to prediction server at url: {url}[/]")
+        results = []
+        answered = asyncio.Event()
+        last = None
+
+        async with websockets.connect(url, max_size=None) as ws:
+
+            async def receive():
+                async for message in ws:
+                    result = json.loads(message)
+                    results.append(result)
+                    if on_result is not None:
+                        on_result(result)
+                    if last is not None and result["frame"] >= last:
+                        answered.set()
+
+            receiver = asyncio.ensure_future(receive())
+            try:
+                seq = -1
+                for seq, frame in enumerate(frames):
+                    tic = time.monotonic()
+                    await ws.send(frame)
+                    if fps:
+                        await asyncio.sleep(
+                            max(0, 1 / fps - (time.monotonic() - tic)))
+                last = seq
+                if last < 0 or results and results[-1]["frame"] >= last:
+                    answered.set()
+                # wait for the last frame's result, or for the server to close
+                waiter = asyncio.ensure_future(answered.wait())
+                await asyncio.wait([waiter, receiver],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+            finally:
+                receiver.cancel()
+        return results
+
+    def stream(self,
+               source: str,
+               confidence=0.5,
+               fps=None,
+               motion=False,
+               on_result=None):
+        """
+        Stream the images of a directory, or the frames of a video file, to the
+        /stream endpoint and return the detections of the processed frames.
+        """
+        frames = iter_frames(source, self.conf.accepted_formats)
+        return asyncio.run(
+            self.stream_frames(frames,
+                               confidence=confidence,
+                               fps=fps,
+                               motion=motion,
+                               on_result=on_result))
 
 
 # if __name__ == "__main__":
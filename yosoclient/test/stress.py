@@ -1,51 +1,319 @@
+"""
+Benchmark suite for the prediction server.
+
+Every scenario (endpoint x model x arrival rate x concurrency) sends the
+test image at a fixed, open-loop arrival rate for `--duration` seconds:
+request `i` is due at `i / rate` whatever happened to the previous ones,
+and at most `concurrency` requests are in flight. Latencies are
+measured from the time a request was due, so the time spent waiting for a
+free slot when the server falls behind is counted (no coordinated omission).
+
+Each request carries a unique payload (the image followed by a counter,
+which the decoders ignore) so that the server's detection cache never
+answers it, unless `--same-payload` measures cache hits on purpose. The
+cache settings of an `--in-process` server are recorded with the results.
+
+Per scenario it reports the p50/p90/p99 latency, the throughput of
+successful requests and the error rate, and writes them to a JSON file
+that `compare` diffs against a previous run.
+
+usage (from the repo root):
+`python -m yosoclient.test.stress run --rate 5 --rate 20 --concurrency 8`
+`python -m yosoclient.test.stress run --in-process --out after.json`
+`python -m yosoclient.test.stress compare before.json after.json`
+"""
+import asyncio
+import itertools
+import json
+import platform
+import threading
+import time
+from datetime import datetime, timezone
+
+import click
+import httpx
+import numpy as np
+
 from yosoclient.config import ClientConfig
-from yosoclient.core import Client
-from multiprocessing import Pool
-from uuid import uuid4
-import os
-import shutil
-import sys
-from time import perf_counter
-from itertools import chain
-from numpy import mean, std
+from yosoclient.console import console
 
 test_image = "./images/apple.jpg"
-stress_images_dir = "./stress_test_images"
+ENDPOINTS = ("predict", "count_objects", "detect")
+
+
+def unique_payload(image: bytes, i: int) -> bytes:
+    """`image` made unique by trailing bytes after its end marker, which the
+    JPEG and PNG decoders ignore, so that it is never a detection cache hit"""
+    return image + b"yoso-bench %d" % i
+
+
+def percentiles(latencies):
+    "p50/p90/p99 and mean of `latencies` (seconds), in milliseconds"
+    if not latencies:
+        return {"p50_ms": None, "p90_ms": None, "p99_ms": None,
+                "mean_ms": None}
+    ms = np.asarray(latencies) * 1e3
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    return {"p50_ms": float(p50), "p90_ms": float(p90),
+            "p99_ms": float(p99), "mean_ms": float(ms.mean())}
+
+
+async def run_scenario(client: httpx.AsyncClient, base_url: str, image: bytes,
+                       endpoint: str, model: str, rate: float,
+                       concurrency: int, duration: float,
+                       confidence: float = 0.5, payloads=None):
+    """Drive one scenario, returning its summary. Requests are made unique
+    (see `unique_payload`) by the numbers drawn from `payloads`, or send
+    `image` as is when it is None."""
+    url = f"{base_url}/{endpoint}"
+    params = {"model": model, "confidence": confidence}
+    slots = asyncio.Semaphore(concurrency)
+    latencies, errors = [], {}
+    n_requests = max(1, int(rate * duration))
+
+    async def one(due):
+        content = image if payloads is None else unique_payload(
+            image, next(payloads))
+        async with slots:
+            try:
+                resp = await client.post(url,
+                                         params=params,
+                                         files={"file": ("image.jpg", content)})
+                outcome = resp.status_code
+            except httpx.HTTPError as e:
+                outcome = type(e).__name__
+        if outcome == 200:
+            latencies.append(time.perf_counter() - due)
+        else:
+            errors[str(outcome)] = errors.get(str(outcome), 0) + 1
+
+    start = time.perf_counter()
+    tasks = []
+    for i in range(n_requests):
+        due = start + i / rate
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        tasks.append(asyncio.ensure_future(one(due)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    n_errors = sum(errors.values())
+    return {
+        "endpoint": endpoint,
+        "model": model,
+        "rate": rate,
+        "concurrency": concurrency,
+        "duration_s": duration,
+        "requests": n_requests,
+        "errors": errors,
+        "error_rate": n_errors / n_requests,
+        "throughput_rps": len(latencies) / elapsed,
+        **percentiles(latencies),
+    }
+
+
+async def run_suite(base_url, image, endpoints, models, rates, concurrencies,
+                    duration, warmup, same_payload=False):
+    results = []
+    payloads = None if same_payload else itertools.count()
+    limits = httpx.Limits(max_connections=max(concurrencies))
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        for endpoint in endpoints:
+            for model in models:
+                # not measured: pays for the first forward passes and the
+                # connection setup
+                for _ in range(warmup):
+                    content = image if payloads is None else unique_payload(
+                        image, next(payloads))
+                    await client.post(f"{base_url}/{endpoint}",
+                                      params={"model": model},
+                                      files={"file": ("image.jpg", content)})
+                for rate in rates:
+                    for concurrency in concurrencies:
+                        result = await run_scenario(client,
+                                                    base_url,
+                                                    image,
+                                                    endpoint,
+                                                    model,
+                                                    rate,
+                                                    concurrency,
+                                                    duration,
+                                                    payloads=payloads)
+                        console.log(format_result(result))
+                        results.append(result)
+    return results
+
 
+def format_result(r):
+    def ms(x):
+        return "-" if x is None else f"{x:.1f}"
 
-def copy_to_rand_path(source: str, dest_dir: str):
-    _, ext = os.path.splitext(source)
-    new_name = str(uuid4()) + ext
-    new_path = os.path.join(dest_dir, new_name)
-    shutil.copy(source, new_path)
-    return new_path
+    return (f"{r['endpoint']:<14}{r['model']:<12}"
+            f"rate={r['rate']:<6g}conc={r['concurrency']:<4}"
+            f"p50={ms(r['p50_ms'])}ms p90={ms(r['p90_ms'])}ms "
+            f"p99={ms(r['p99_ms'])}ms {r['throughput_rps']:.1f} req/s "
+            f"errors={r['error_rate']:.1%}")
 
 
-def worker(times=20):
-    res = []
-    for i in range(times):
+class InProcessServer:
+    """Serve `yoso.core:app` with uvicorn on a background thread of this
+    process, for benchmarks without a separately started server"""
+
+    def __init__(self, port: int):
+        import uvicorn
+        from yoso.core import app
+
+        self.server = uvicorn.Server(
+            uvicorn.Config(app, host="127.0.0.1", port=port,
+                           log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.url = f"http://127.0.0.1:{port}"
+
+    @staticmethod
+    def cache_state():
+        "Detection cache settings of the served app"
+        from yoso.core import config
+
+        return {
+            "enabled": config.cache_enabled,
+            "max_entries": config.cache_max_entries,
+            "ttl_seconds": config.cache_ttl_seconds,
+        }
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def wait_ready(base_url: str, timeout: float = 300):
+    "Wait for the server's `/ready` probe to answer 200"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/ready").status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"{base_url} was not ready after {timeout}s")
+
+
+@click.group(help="Benchmark suite for the YOSO prediction service")
+def cli():
+    pass
+
+
+@cli.command(help="Run the benchmark scenarios and save their results")
+@click.option("--endpoint",
+              "endpoints",
+              multiple=True,
+              type=click.Choice(ENDPOINTS),
+              default=["predict"],
+              show_default=True)
+@click.option("--model",
+              "models",
+              multiple=True,
+              default=["yolov3-tiny"],
+              show_default=True)
+@click.option("--rate",
+              "rates",
+              multiple=True,
+              type=click.FloatRange(min=0, min_open=True),
+              default=[5.0],
+              show_default=True,
+              help="Arrival rate, in requests per second")
+@click.option("--concurrency",
+              "concurrencies",
+              multiple=True,
+              type=click.IntRange(min=1),
+              default=[4],
+              show_default=True,
+              help="Maximum requests in flight")
+@click.option("--duration", type=click.FLOAT, default=10.0, show_default=True)
+@click.option("--warmup", type=click.IntRange(min=0), default=3,
+              show_default=True)
+@click.option("--image", type=click.Path(exists=True), default=test_image,
+              show_default=True)
+@click.option("--in-process",
+              is_flag=True,
+              help="Serve yoso.core:app from this process")
+@click.option("--port", type=click.INT, default=8765, show_default=True,
+              help="Port of the in-process server")
+@click.option("--same-payload",
+              is_flag=True,
+              help="Send the very same image every time, so that the "
+              "server's detection cache answers after the first request")
+@click.option("--out", type=click.Path(), default="bench_results.json",
+              show_default=True)
+def run(endpoints, models, rates, concurrencies, duration, warmup, image,
+        in_process, port, same_payload, out):
+    with open(image, "rb") as f:
+        content = f.read()
+    meta = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "image": image,
+        "image_bytes": len(content),
+        "in_process": in_process,
+        "warmup": warmup,
+        "unique_payloads": not same_payload,
+    }
+
+    def bench(base_url):
+        wait_ready(base_url)
+        meta["url"] = base_url
+        return asyncio.run(
+            run_suite(base_url, content, endpoints, models, rates,
+                      concurrencies, duration, warmup, same_payload))
+
+    if in_process:
+        with InProcessServer(port) as server:
+            meta["server_cache"] = server.cache_state()
+            results = bench(server.url)
+    else:
         config = ClientConfig()
-        client = Client(config)
-        path = copy_to_rand_path(test_image, stress_images_dir)
-        tic = perf_counter()
-        resp = client.predict_request(path)
-        toc = perf_counter()
-        elaps = toc - tic
-        print(f"Requedst took: {elaps:0.4f} seconds")
-        res.append(elaps)
-    return res
+        results = bench(f"http://{config.host}:{config.port}")
 
+    with open(out, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    console.log(f"[green]Results saved to {out}[/]")
 
-if __name__ == "__main__":
 
-    n_procs = int(sys.argv[1])
+def scenario_key(r):
+    return (r["endpoint"], r["model"], r["rate"], r["concurrency"])
+
 
-    if not os.path.exists(stress_images_dir):
-        os.mkdir(stress_images_dir)
+@cli.command(help="Compare the results of two runs, scenario by scenario")
+@click.argument("baseline", type=click.Path(exists=True))
+@click.argument("candidate", type=click.Path(exists=True))
+def compare(baseline, candidate):
+    with open(baseline) as f:
+        before = {scenario_key(r): r for r in json.load(f)["results"]}
+    with open(candidate) as f:
+        after = {scenario_key(r): r for r in json.load(f)["results"]}
 
-    with Pool(processes=n_procs) as p:
-        ress = p.map(worker, [20] * 5)
+    def delta(key, a, b):
+        if a[key] is None or b[key] is None:
+            return f"{key}: -"
+        change = (b[key] - a[key]) / a[key] if a[key] else 0.0
+        return f"{key}: {a[key]:.1f} -> {b[key]:.1f} ({change:+.1%})"
 
-    res = list(chain(ress))
+    for key in sorted(set(before) & set(after)):
+        a, b = before[key], after[key]
+        endpoint, model, rate, concurrency = key
+        console.log(f"[yellow]{endpoint} {model} rate={rate:g} "
+                    f"conc={concurrency}[/]")
+        for metric in ("p50_ms", "p90_ms", "p99_ms", "throughput_rps"):
+            console.log("  " + delta(metric, a, b))
+        console.log(f"  error_rate: {a['error_rate']:.1%} -> "
+                    f"{b['error_rate']:.1%}")
+    for key in sorted(set(before) ^ set(after)):
+        console.log(f"[red]only in one run: {key}[/]")
 
-    print(mean(res), "+-", std(res), "sec")
+
+if __name__ == "__main__":
+    cli()